@@ -0,0 +1,98 @@
+import argparse
+import os
+import re
+import shutil
+import sys
+import numpy as np
+from typing import Dict
+
+from create_PI_key_partition_lookups import ORIGINAL_C_PI_KEY, extract_matrix_from_text, format_array_as_c
+
+# the bundle format lives with its runtime loader in ../prototype
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "prototype"))
+from key_artifacts import DEFAULT_KEY_ARTIFACT_DIR, KEY_ARTIFACT_VERSION, PI_KEY_SHA256, key_sha256, load_key_bundle, verify_key_bundle, write_key_bundle  # noqa: E402
+
+"""
+This script parses a 32x64 SWIFFT key once and writes its key artifact bundle (see prototype/key_artifacts.py):
+a manifest.json with the version and content hashes, one .npy per layout (key, key_transposed, partitions,
+padded_partitions) and a C header {name}.h holding the same arrays for src/, generated from the bundle that
+was just written so the C and Python tables cannot drift apart.
+
+The key defaults to the PI key and is written to key_artifacts/PI_key, where the runtime modules look for it.
+A custom key can be given as a C source file (only the numbers between the braces are read) or a .npy file,
+together with a --name other than PI_key.
+"""
+
+
+def load_key_file(path: str) -> np.ndarray:
+    if path.endswith(".npy"):
+        return np.load(path)
+    with open(path) as f:
+        return extract_matrix_from_text(f.read(), 32, 64)
+
+def format_key_header(bundle, name: str) -> str:
+    """ C header with every array of the bundle, named {name}, {name}_transposed, {name}_partition_{p}, ... """
+    header = "#pragma once\n\n#include <stdint.h>\n\n"
+    header += f"/* generated by lookup_generation/build_key_artifacts.py from the {name} key artifact bundle, do not edit */\n"
+    header += f"#define {name.upper()}_ARTIFACT_VERSION {KEY_ARTIFACT_VERSION}\n"
+    header += f"#define {name.upper()}_SHA256 \"{bundle.sha256}\"\n\n"
+
+    c_type = "static const int16_t __attribute__((aligned(64)))"
+    header += format_array_as_c(bundle["key"], name, 64, c_type) + "\n"
+    header += format_array_as_c(bundle["key_transposed"], f"{name}_transposed", 32, c_type) + "\n"
+    for p in range(4):
+        header += format_array_as_c(bundle["partitions"][p], f"{name}_partition_{p}", 16, c_type) + "\n"
+    for p in range(4):
+        header += format_array_as_c(bundle["padded_partitions"][p], f"{name}_padded_partition_{p}", 16, c_type) + "\n"
+    return header
+
+def parse_c_arrays(text: str) -> Dict[str, np.ndarray]:
+    """ Every 'name[size] = { ... }' array of a C source, flattened """
+    arrays = {}
+    for (name, body) in re.findall(r'(\w+)\[\d+\]\s*=\s*\{([^}]*)\}', text):
+        arrays[name] = np.array([int(num) for num in re.findall(r'-?\d+', body)])
+    return arrays
+
+def check_header(header: str, bundle, name: str):
+    # the header must hold exactly the bundle's arrays
+    arrays = parse_c_arrays(header)
+    assert(np.array_equal(arrays[name], bundle["key"].flatten()))
+    assert(np.array_equal(arrays[f"{name}_transposed"], bundle["key_transposed"].flatten()))
+    for p in range(4):
+        assert(np.array_equal(arrays[f"{name}_partition_{p}"], bundle["partitions"][p].flatten()))
+        assert(np.array_equal(arrays[f"{name}_padded_partition_{p}"], bundle["padded_partitions"][p].flatten()))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build the versioned, content hashed key artifact bundle and its C header")
+    parser.add_argument("--key-file", help="C source or .npy holding a custom 32x64 key (default: the PI key)")
+    parser.add_argument("--name", help="key name, used for the C identifiers (PI_key by default, required with --key-file)")
+    parser.add_argument("--out-dir", help="bundle directory (default: key_artifacts/{name} next to prototype/)")
+    parser.add_argument("--src-dir", help="also copy the C header here (e.g. src)")
+    args = parser.parse_args()
+
+    if args.key_file is not None and args.name is None:
+        parser.error("--key-file needs a --name, a custom key must not be written as the PI key")
+    args.name = args.name or "PI_key"
+
+    key = extract_matrix_from_text(ORIGINAL_C_PI_KEY, 32, 64) if args.key_file is None else load_key_file(args.key_file)
+    if np.abs(key).max() > 256:
+        raise ValueError("key entries must lie in [-256, 256]")
+    # the runtime loads key_artifacts/PI_key as the PI key
+    if args.name == "PI_key" and key_sha256(key) != PI_KEY_SHA256:
+        parser.error("only the PI key may be named PI_key")
+    out_dir = args.out_dir or os.path.join(os.path.dirname(DEFAULT_KEY_ARTIFACT_DIR), args.name)
+
+    manifest = write_key_bundle(key, out_dir, args.name)
+    bundle = load_key_bundle(out_dir)
+    assert(verify_key_bundle(out_dir))
+    print(f"Key artifacts of {args.name} (sha256 {manifest['sha256']}) written to {out_dir}/")
+
+    header = format_key_header(bundle, args.name)
+    check_header(header, bundle, args.name)
+    header_path = os.path.join(out_dir, f"{args.name}.h")
+    with open(header_path, "w") as f:
+        f.write(header)
+    if args.src_dir:
+        shutil.copy(header_path, args.src_dir)
+    print(f"C header written to {header_path}" + (f" and copied to {args.src_dir}/" if args.src_dir else ""))
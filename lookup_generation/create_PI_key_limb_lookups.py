@@ -0,0 +1,55 @@
+import argparse
+import os
+import sys
+import numpy as np
+
+from create_PI_key_partition_lookups import ORIGINAL_C_PI_KEY, extract_matrix_from_text, format_array_as_c
+
+# the limb decomposition lives in ../prototype
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "prototype"))
+from amx_tile_emulator import vnni_pack  # noqa: E402
+from int8_limbs import describe_schedule, choose_schedule, prepare_key_limbs  # noqa: E402
+
+"""
+This script splits the SWIFFT_PI_key into the int8 limbs of the cheapest exact AMX-INT8 schedule found by
+prototype/int8_limbs.py and saves them as VNNI formatted B tiles, one per (limb product, partition):
+
+ - a packed product (two fftout limbs concatenated along K) gets the 64x16 key limb partition [K_p ; K_p]
+ - an unpacked product gets the bare 32x16 key limb partition (an 8 row B tile)
+
+together with the 32x64 mask of fftout entries the kernel has to negate (key entries of 128 stored as -128).
+"""
+
+
+def create_limb_partitions(SWIFFT_PI_key: np.ndarray, schedule):
+
+    key_limbs, flip = prepare_key_limbs(SWIFFT_PI_key, schedule)
+
+    tiles = []
+    for (i, limb_product) in enumerate(schedule.products):
+        for p in range(4):
+            # stack the key limb partition once per term of the product
+            B = np.concatenate([key_limbs[b][:, 16 * p:16 * p + 16] for (_, b) in limb_product.terms], axis=0)
+            tiles.append((f"PI_key_limb_product{i}_partition_{p}", vnni_pack(B)))
+    return tiles, flip
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write the int8 limb split PI key tiles as C arrays")
+    parser.add_argument("--out-dir", default="PI_key_limb_lookups", help="directory to write PI_key_limbs.c to")
+    parser.add_argument("--reduction", default="mod257", choices=["mod257", "exact"])
+    args = parser.parse_args()
+
+    SWIFFT_PI_key = extract_matrix_from_text(ORIGINAL_C_PI_KEY, 32, 64)
+    schedule = choose_schedule((0, 256), (int(SWIFFT_PI_key.min()), int(SWIFFT_PI_key.max())), args.reduction)
+    print(describe_schedule(schedule))
+
+    tiles, flip = create_limb_partitions(SWIFFT_PI_key, schedule)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    with open(os.path.join(args.out_dir, "PI_key_limbs.c"), "w") as f:
+        f.write("#include <stdint.h>\n\n/*\n" + describe_schedule(schedule) + "\n*/\n\n")
+        for (name, tile) in tiles:
+            f.write(format_array_as_c(tile, name, 64, "const int8_t" if tile.dtype == np.int8 else "const uint8_t") + "\n")
+        f.write(format_array_as_c(flip.astype(np.uint8), "PI_key_fftout_negate_mask", 64, "const uint8_t"))
+    print(f"Limb tiles written to {args.out_dir}/PI_key_limbs.c")
@@ -1,11 +1,25 @@
+import os
+import sys
 import numpy as np
 import re # regular expressions
-from typing import List
+
+# the VNNI packer and the tile emulator live in ../prototype
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "prototype"))
+from amx_tile_emulator import emulate_fftsum, vnni_pack, vnni_unpack  # noqa: E402
+from int8_limbs import choose_schedule  # noqa: E402
 
 """
 This script creates 4 partitions of size (32, 16) of the SWIFFT_PI_key (originally a 32x64 matrix).
 These 4 partitions are then zero padded to (64, 16) to fit the 64x16 size of an AMX tile. They are
 then formatted and saved as row-major order 64x16 C matrices
+
+The zero padding is only needed while each TDPB* op consumes one partition. Key entries span [-128, 128]
+and fftout entries [0, 256], so the tiles are fed as int8 limbs (prototype/int8_limbs.py), and the empty
+half of the 64 deep dot product is filled with the second fftout limb against the same key limb
+partition, [F0_p | F1_p] @ [K_p ; K_p]. Those packed byte VNNI B tiles are written by
+create_PI_key_limb_lookups.py. packed_fftsum_model() runs the same layout through the AMX tile emulator
+(prototype/amx_tile_emulator.py) and checks it against the padded one: the same fftsum with half the
+tile loads, bytes, TDPB* ops and MACs.
 """
 
 
@@ -13,15 +27,17 @@ ORIGINAL_C_PI_KEY = " {	-116,  78,-118,  75, -19, -52,-128, 126,	  22, -12, -60,
 
 
 def extract_matrix_from_text( input_text: str, num_rows: int, num_columns: int ) -> np.ndarray:
-    # extract numbers
+    # extract numbers from the initializer only
+    if '{' in input_text:
+        input_text = input_text[input_text.index('{') + 1:input_text.rindex('}')]
     numbers = re.findall(r'-?\d+', input_text)
     # to np array
     return np.array([int(num) for num in numbers]).reshape(num_rows, num_columns)
 
-def format_array_as_c(array: np.ndarray, array_name: str, elements_per_line=16):
+def format_array_as_c(array: np.ndarray, array_name: str, elements_per_line=16, c_type="int8_t"):
     # Ensure array is of integer type
-    array = array.astype(int)
-    array_str = f"int8_t {array_name}[{array.size}] = {{\n    "
+    array = array.astype(int).flatten()
+    array_str = f"{c_type} {array_name}[{array.size}] = {{\n    "
     for i in range(0, array.size, elements_per_line):
         # Convert each element to int, then to string, and join them with comma
         line = ', '.join(str(int(num)) for num in array[i:i+elements_per_line])
@@ -54,6 +70,40 @@ def create_padded_partitions():
 
     return padded_partitions, SWIFFT_PI_key
 
+def packed_fftsum_model(fftout: np.ndarray, SWIFFT_PI_key: np.ndarray, layout: str = "packed"):
+    """ fftsum mod 257 of a (B, 32, 64) fftout stack through emulated AMX tiles, and the per block tile counters """
+    schedule = choose_schedule((0, 256), (int(SWIFFT_PI_key.min()), int(SWIFFT_PI_key.max())))
+    return emulate_fftsum(fftout, SWIFFT_PI_key, schedule, layout)
+
+def test_vnni_pack_matches_c_transform():
+
+    B = np.random.randint(0, 256, (64, 16))
+
+    # straight port of the loop in transform()
+    expected = np.zeros((16, 64), dtype=B.dtype)
+    for m in range(16):
+        for n in range(16):
+            for m_in in range(4):
+                expected[m, 4 * n + m_in] = B[4 * m + m_in, n]
+
+    assert(np.array_equal(vnni_pack(B), expected))
+    assert(np.array_equal(vnni_unpack(vnni_pack(B)), B))
+    print("test_vnni_pack_matches_c_transform()... PASS!")
+
+def test_packed_layout_matches_hadamard_column_sum():
+
+    _, SWIFFT_PI_key = create_padded_partitions()
+    fftout = np.random.randint(0, 257, (10, 32, 64))
+    expected = np.sum(fftout * SWIFFT_PI_key, axis=1) % 257
+
+    (packed, packed_counters), (padded, padded_counters) = [packed_fftsum_model(fftout, SWIFFT_PI_key, layout) for layout in ("packed", "padded")]
+    assert(np.array_equal(packed, expected) and np.array_equal(padded, expected))
+
+    # filling the zero padding halves every tile cost
+    assert(2 * packed_counters.tile_loads == padded_counters.tile_loads and 2 * packed_counters.bytes_loaded == padded_counters.bytes_loaded)
+    assert(2 * packed_counters.dot_product_ops == padded_counters.dot_product_ops and 2 * packed_counters.macs == padded_counters.macs)
+    print("test_packed_layout_matches_hadamard_column_sum()... PASS!")
+
 if __name__ == "__main__" :
     
 
@@ -70,9 +120,15 @@ if __name__ == "__main__" :
 
     # Convert 64x16 Pi_key into formated row-major order C arrays
     flattened_partitions = [p.flatten() for p in padded_partitions]
-    formated_c_arrays = [ format_array_as_c(p, f"PI_key_padded_partition_{i}", 16) for (i, p) in enumerate(flattened_partitions)]
-
-    # # save to amx_test_inputs dir as c 
-    # for (i, c_array) in enumerate(formated_c_arrays):
-    #     with open(f"PI_key_padded_partitions/PI_key_padded_partition{i}.c", "w") as f:
-    #         f.write(c_array)
+    # key entries of 128 do not fit int8_t
+    formated_c_arrays = [ format_array_as_c(p, f"PI_key_padded_partition_{i}", 16, "const int16_t") for (i, p) in enumerate(flattened_partitions)]
+
+    # save to PI_key_padded_partitions dir as c 
+    os.makedirs("PI_key_padded_partitions", exist_ok=True)
+    for (i, c_array) in enumerate(formated_c_arrays):
+        with open(f"PI_key_padded_partitions/PI_key_padded_partition{i}.c", "w") as f:
+            f.write(c_array)
+
+    # packed layout, see create_PI_key_limb_lookups.py for its byte VNNI tiles
+    test_vnni_pack_matches_c_transform()
+    test_packed_layout_matches_hadamard_column_sum()
@@ -0,0 +1,48 @@
+import argparse
+import os
+import sys
+import numpy as np
+
+from create_PI_key_partition_lookups import format_array_as_c
+
+# the table math lives with the runtime evaluator in ../prototype
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "prototype"))
+from swifft_fused_lookup import FUSED_TABLE_SHAPE, build_fused_tables, byte_fft_tables, fused_compress  # noqa: E402
+from swifft_compression import compress, generate_dummy_blocks  # noqa: E402
+
+"""
+This script writes the lookup tables used by the fused FFT+fftsum evaluator (prototype/swifft_fused_lookup.py):
+
+ - SWIFFT_byte_fft_table:  (8, 256, 64)   FFT of every byte value at every byte offset of a row, mod 257
+ - SWIFFT_fused_PI_table:  (256, 256, 64) the same with the matching PI key slice multiplied in, i.e. the
+                           contribution of every (input byte position, byte value) pair to the 64 outputs
+
+Each table is saved as a .npy (for np.load(mmap_mode='r')) and as a row-major order C array.
+"""
+
+
+def save_table(table: np.ndarray, name: str, out_dir: str):
+    np.save(os.path.join(out_dir, f"{name}.npy"), table)
+    with open(os.path.join(out_dir, f"{name}.c"), "w") as f:
+        f.write("#include <stdint.h>\n\n")
+        f.write(f"// shape {table.shape}, values mod 257\n")
+        f.write(format_array_as_c(table, name, 16, "const int16_t"))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write the fused FFT+fftsum lookup tables as .npy and C arrays")
+    parser.add_argument("--out-dir", default="fused_fft_lookups", help="directory to write the .npy and .c tables to")
+    args = parser.parse_args()
+
+    fused_tables = build_fused_tables()
+    assert(fused_tables.shape == FUSED_TABLE_SHAPE)
+
+    # ensure gather-and-add over the tables reproduces the FFT + fftsum path
+    blocks = generate_dummy_blocks(64)
+    assert(np.array_equal(fused_compress(blocks, fused_tables), compress(blocks)))
+    print("Fused tables reproduce the SWIFFT compression!")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    save_table(byte_fft_tables(), "SWIFFT_byte_fft_table", args.out_dir)
+    save_table(fused_tables, "SWIFFT_fused_PI_table", args.out_dir)
+    print(f"Tables written to {args.out_dir}/")
@@ -48,11 +48,11 @@ def amx_hadamard_with_collapsing_sum_prototype(dummy_fftout: np.ndarray, key: np
 
     # concatenate each dummy fftout partition with a 16x32 zero matrix to get 16x64
     # this is to fit the 16x64 size of the amx tile A 
-    dummy_fftout_partitions_padded = [np.concatenate([partition, np.zeros((16, 32))], axis=1) for partition in dummy_fftout_partitions]
+    dummy_fftout_partitions_padded = [np.concatenate([partition, np.zeros((16, 32), dtype=partition.dtype)], axis=1) for partition in dummy_fftout_partitions]
     assert(dummy_fftout_partitions_padded[0].shape == (16, 64))
     # concatenate each key partition with a 32x16 zero matrix to get 64x16
     # this is to fit the 64x16 size of the amx tile A 
-    key_partitions_padded = [np.concatenate([partition, np.zeros((32, 16))], axis=0) for partition in key_partitions]
+    key_partitions_padded = [np.concatenate([partition, np.zeros((32, 16), dtype=partition.dtype)], axis=0) for partition in key_partitions]
     assert(key_partitions_padded[0].shape == (64, 16))
 
     # compute matmul of likewise padded partions of A and B (using amx tiles in full implementation)
@@ -62,10 +62,11 @@ def amx_hadamard_with_collapsing_sum_prototype(dummy_fftout: np.ndarray, key: np
     return np.concatenate([np.diagonal(p) for p in likewise_AB_partitions_products])
 
 def extract_matrix_from_text(input_text: str, num_rows: int, num_columns: int) -> np.ndarray:
-    # extract numbers
+    # extract numbers from the initializer only (the declaration holds the 16 of int16_t)
+    if '{' in input_text:
+        input_text = input_text[input_text.index('{') + 1:input_text.rindex('}')]
     numbers = re.findall(r'-?\d+', input_text)
-    # to int (skipping the 16 from int16_t)
-    int_numbers = [int(num) for num in numbers][1:]
+    int_numbers = [int(num) for num in numbers]
     # return as np array
     return np.array(int_numbers).reshape(num_rows, num_columns)
 
@@ -0,0 +1,387 @@
+import numpy as np
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from amx_fftsum_prototype import SWIFFT_N
+from batched_fftsum import generate_dummy_fftout_batch, load_pi_key, batched_fftsum
+from int8_limbs import LIMB_SPLITS, LimbSchedule, build_products, choose_schedule, prepare_fftout_limbs, prepare_key_limbs, recombine, verify_schedule
+
+"""
+This file contains a bit accurate NumPy emulator of the AMX tile state and instructions used in
+src/amx-matmul.h, so kernels and fftsum layouts can be checked and costed on hosts without AMX.
+
+Emulated (palette 1, per the Intel SDM):
+
+ - LDTILECFG / TILERELEASE: the 64 byte config block built in amx_dpbuud(): palette id, start row,
+   16 little-endian uint16 bytes-per-row entries at offset 16, 16 row counts at offset 48. Palette 1
+   has 8 tiles of at most 16 rows x 64 bytes. Loading a config zeroes all tiles.
+ - TILELOADD / TILESTORED: rows x colsb bytes at base + offset + row * stride.
+ - TILEZERO
+ - TDPBSSD / TDPBSUD / TDPBUSD / TDPBUUD: C[m, n] += sum_k sum_i A[m, 4k + i] * B[k, 4n + i] with
+   A a M x 4K byte tile, B a K x 4N byte tile in VNNI format and C a M x N int32 tile, signed or
+   unsigned bytes per the instruction, accumulated with int32 wraparound.
+
+Every tile register carries a leading batch axis: the emulator runs B independent instances of one
+instruction stream in lockstep (memory operands are (nbytes,) arrays shared by all instances or
+(B, nbytes) arrays with one row per instance). The counters describe one instance: tile loads and
+stores, bytes moved, TDPB* ops, multiply-accumulates and config loads, which is the cost model used
+to compare fftsum layouts before running on a Sapphire Rapids machine.
+"""
+
+
+MAX_TILES = 8
+MAX_ROWS = 16
+MAX_COLSB = 64
+
+
+class TileFault(Exception):
+    """ The emulated instruction would fault (#UD / #GP) on hardware """
+
+
+@dataclass
+class TileCounters:
+    config_loads: int = 0
+    tile_loads: int = 0
+    tile_stores: int = 0
+    tile_zeros: int = 0
+    bytes_loaded: int = 0
+    bytes_stored: int = 0
+    dot_product_ops: int = 0
+    macs: int = 0
+
+
+@dataclass(frozen=True)
+class TileConfig:
+    palette: int
+    start_row: int
+    colsb: Tuple[int, ...]
+    rows: Tuple[int, ...]
+
+    @classmethod
+    def from_bytes(cls, config: bytes) -> "TileConfig":
+        config = bytes(config)
+        if len(config) != 64:
+            raise TileFault(f"tile config must be 64 bytes, got {len(config)}")
+        if any(config[2:16]):
+            raise TileFault("reserved tile config bytes must be zero")
+        colsb = tuple(int.from_bytes(config[16 + 2 * t:18 + 2 * t], 'little') for t in range(16))
+        rows = tuple(config[48:64])
+        if config[0] != 1:
+            raise TileFault(f"unsupported palette {config[0]}")
+        for t in range(16):
+            if t >= MAX_TILES and (colsb[t] or rows[t]):
+                raise TileFault(f"palette 1 has no tile {t}")
+            if rows[t] > MAX_ROWS or colsb[t] > MAX_COLSB or (rows[t] == 0) != (colsb[t] == 0):
+                raise TileFault(f"invalid shape {rows[t]} x {colsb[t]} for tile {t}")
+        return cls(config[0], config[1], colsb[:MAX_TILES], rows[:MAX_TILES])
+
+    def to_bytes(self) -> bytes:
+        config = bytearray(64)
+        config[0] = self.palette
+        config[1] = self.start_row
+        for t in range(MAX_TILES):
+            config[16 + 2 * t:18 + 2 * t] = self.colsb[t].to_bytes(2, 'little')
+            config[48 + t] = self.rows[t]
+        return bytes(config)
+
+
+def make_tile_config(shapes: dict) -> bytes:
+    """ {tile: (rows, colsb)} -> 64 byte palette 1 config block """
+    rows = [0] * MAX_TILES
+    colsb = [0] * MAX_TILES
+    for (t, (r, c)) in shapes.items():
+        rows[t], colsb[t] = r, c
+    return TileConfig(1, 0, tuple(colsb), tuple(rows)).to_bytes()
+
+def vnni_pack(matrix: np.ndarray) -> np.ndarray:
+    """ (..., K, N) -> (..., K/4, 4N), the B tile format of transform() in src/amx-matmul.h """
+    K, N = matrix.shape[-2:]
+    if K % 4:
+        raise ValueError(f"VNNI packing needs a multiple of 4 rows, got {K}")
+    return matrix.reshape(*matrix.shape[:-2], K // 4, 4, N).swapaxes(-1, -2).reshape(*matrix.shape[:-2], K // 4, 4 * N)
+
+def vnni_unpack(matrix: np.ndarray) -> np.ndarray:
+    """ (..., K/4, 4N) -> (..., K, N), inverse of vnni_pack() """
+    K_4, N_4 = matrix.shape[-2:]
+    return matrix.reshape(*matrix.shape[:-2], K_4, N_4 // 4, 4).swapaxes(-1, -2).reshape(*matrix.shape[:-2], 4 * K_4, N_4 // 4)
+
+
+class AMXTileEmulator:
+
+    def __init__(self, batch: int = 1):
+        self.batch = batch
+        self.tiles = np.zeros((MAX_TILES, batch, MAX_ROWS, MAX_COLSB), dtype=np.uint8)
+        self.config: Optional[TileConfig] = None
+        self.counters = TileCounters()
+
+    def ldtilecfg(self, config: bytes):
+        self.config = TileConfig.from_bytes(config)
+        self.tiles[...] = 0
+        self.counters.config_loads += 1
+
+    def tilerelease(self):
+        self.config = None
+        self.tiles[...] = 0
+
+    def _shape(self, t: int) -> Tuple[int, int]:
+        if self.config is None:
+            raise TileFault("no tile config loaded")
+        if not 0 <= t < MAX_TILES or self.config.rows[t] == 0:
+            raise TileFault(f"tile {t} is not configured")
+        return self.config.rows[t], self.config.colsb[t]
+
+    def _addresses(self, t: int, memory: np.ndarray, offset: int, stride: int) -> np.ndarray:
+        rows, colsb = self._shape(t)
+        addresses = offset + stride * np.arange(rows)[:, None] + np.arange(colsb)[None, :]
+        if offset < 0 or addresses.max() >= memory.shape[-1]:
+            raise TileFault(f"tile {t} access outside of the {memory.shape[-1]} byte buffer")
+        return addresses
+
+    def tileloadd(self, t: int, memory: np.ndarray, offset: int, stride: int):
+        if memory.dtype != np.uint8:
+            memory = memory.view(np.uint8)
+        rows, colsb = self._shape(t)
+        addresses = self._addresses(t, memory, offset, stride)
+
+        # rows / columns beyond the configured shape are zeroed
+        self.tiles[t] = 0
+        self.tiles[t, :, :rows, :colsb] = memory[..., addresses]
+        self.counters.tile_loads += 1
+        self.counters.bytes_loaded += rows * colsb
+
+    def tilestored(self, t: int, memory: np.ndarray, offset: int, stride: int):
+        rows, colsb = self._shape(t)
+        addresses = self._addresses(t, memory.view(np.uint8), offset, stride)
+        if memory.ndim != 2 or memory.shape[0] != self.batch:
+            raise TileFault(f"tilestored needs a ({self.batch}, nbytes) buffer, got {memory.shape}")
+        np.put_along_axis(memory.view(np.uint8), np.broadcast_to(addresses.ravel(), (self.batch, addresses.size)),
+                          self.tiles[t, :, :rows, :colsb].reshape(self.batch, -1), axis=1)
+        self.counters.tile_stores += 1
+        self.counters.bytes_stored += rows * colsb
+
+    def tilezero(self, t: int):
+        self._shape(t)
+        self.tiles[t] = 0
+        self.counters.tile_zeros += 1
+
+    def tile_as_int32(self, t: int) -> np.ndarray:
+        """ (batch, rows, colsb / 4) int32 view of a tile's configured shape """
+        rows, colsb = self._shape(t)
+        return self.tiles[t, :, :rows, :colsb].copy().view(np.int32)
+
+    def _tdpb(self, dst: int, a: int, b: int, a_signed: bool, b_signed: bool):
+        (m, c_colsb), (a_rows, a_colsb), (k, b_colsb) = self._shape(dst), self._shape(a), self._shape(b)
+        if len({dst, a, b}) != 3:
+            raise TileFault("TDPB* operands must be distinct tiles")
+        if c_colsb % 4 or a_colsb % 4 or b_colsb % 4:
+            raise TileFault("TDPB* tiles must have a multiple of 4 bytes per row")
+        if a_rows != m or a_colsb // 4 != k or b_colsb != c_colsb:
+            raise TileFault(f"TDPB* shape mismatch: C {m}x{c_colsb}, A {a_rows}x{a_colsb}, B {k}x{b_colsb}")
+        n = c_colsb // 4
+
+        A = self.tiles[a, :, :m, :a_colsb].view(np.int8 if a_signed else np.uint8).reshape(self.batch, m, k, 4)
+        B = self.tiles[b, :, :k, :b_colsb].view(np.int8 if b_signed else np.uint8).reshape(self.batch, k, n, 4)
+        C = self.tile_as_int32(dst).astype(np.int64)
+
+        # exact products, then int32 wraparound like the hardware accumulator
+        C += np.einsum('bmki,bkni->bmn', A.astype(np.int64), B.astype(np.int64))
+        self.tiles[dst, :, :m, :c_colsb] = C.astype(np.int32).view(np.uint8).reshape(self.batch, m, c_colsb)
+        self.counters.dot_product_ops += 1
+        self.counters.macs += m * n * k * 4
+
+    def tdpbssd(self, dst: int, a: int, b: int):
+        self._tdpb(dst, a, b, True, True)
+
+    def tdpbsud(self, dst: int, a: int, b: int):
+        self._tdpb(dst, a, b, True, False)
+
+    def tdpbusd(self, dst: int, a: int, b: int):
+        self._tdpb(dst, a, b, False, True)
+
+    def tdpbuud(self, dst: int, a: int, b: int):
+        self._tdpb(dst, a, b, False, False)
+
+
+def emulate_amx_dpbuud(M: int, K: int, N: int, A: np.ndarray, B: np.ndarray) -> Tuple[np.ndarray, TileCounters]:
+    """ amx_dpbuud() from src/amx-matmul.h: A = M x 4K uint8, B = K x 4N uint8 (VNNI), C = M x N uint32 """
+    # the config block of amx_dpbuud(), byte for byte
+    config = bytes([0x01, 0x00] + [0x00] * 14 + [4 * K, 0, 4 * N, 0, 4 * N, 0, 1, 0] + [0x00] * 24 + [M, K, M, 1] + [0x00] * 12)
+
+    amx = AMXTileEmulator()
+    amx.ldtilecfg(config)
+    C = np.zeros((1, 4 * M * N), dtype=np.uint8)
+
+    amx.tilezero(2)
+    amx.tileloadd(0, np.ascontiguousarray(A, dtype=np.uint8).ravel(), 0, 4 * K)
+    amx.tileloadd(1, np.ascontiguousarray(B, dtype=np.uint8).ravel(), 0, 4 * N)
+    amx.tdpbuud(2, 0, 1)
+    amx.tilestored(2, C, 0, 4 * N)
+
+    return C.view(np.uint32).reshape(M, N), amx.counters
+
+# tiles used by emulate_fftsum(): one A / B pair per dot product depth, one shared C
+TILE_C, TILE_A64, TILE_B64, TILE_A32, TILE_B32 = 0, 1, 2, 3, 4
+
+def emulate_fftsum(fftout: np.ndarray, key: Optional[np.ndarray] = None, schedule: Optional[LimbSchedule] = None,
+                   layout: str = "packed") -> Tuple[np.ndarray, TileCounters]:
+    """
+    Runs the fftsum of a (B, 32, 64) fftout stack through emulated AMX tiles under an int8 limb
+    schedule (int8_limbs.py) and returns the recombined (B, 64) result and the per block counters.
+
+    layout "padded": every limb term gets its own op with zero padded 16x64 A / 64x16 B tiles, as in
+                     the prototype and create_padded_partitions()
+    layout "packed": unpadded 16x32 A / 8 row B tiles for single term products, 64-deep tiles holding
+                     both terms for packed products (create_PI_key_limb_lookups.py, int8_limbs.py)
+    """
+    if layout not in ("padded", "packed"):
+        raise ValueError(f"unknown layout {layout}")
+    key = load_pi_key() if key is None else key
+    schedule = choose_schedule() if schedule is None else schedule
+    batch = fftout.shape[0]
+
+    key_limbs, flip = prepare_key_limbs(key, schedule)
+    fftout_limbs = prepare_fftout_limbs(fftout, schedule, flip)
+
+    amx = AMXTileEmulator(batch)
+    amx.ldtilecfg(make_tile_config({TILE_C: (16, 64), TILE_A64: (16, 64), TILE_B64: (16, 64), TILE_A32: (16, 32), TILE_B32: (8, 64)}))
+    C = np.zeros((batch, 16 * 64), dtype=np.uint8)
+
+    partials = []
+    for limb_product in schedule.products:
+        partial = np.zeros((batch, SWIFFT_N), dtype=np.int32)
+
+        # the padded layout runs each term of a packed product as an op of its own
+        for terms in ([(term,) for term in limb_product.terms] if layout == "padded" else [limb_product.terms]):
+            deep = len(terms) == 2 or layout == "padded"
+            tile_a, tile_b = (TILE_A64, TILE_B64) if deep else (TILE_A32, TILE_B32)
+
+            for p in range(SWIFFT_N // 16):
+                # A: 16 outputs x the limb columns of the transposed fftout, B: likewise key limb partitions
+                A = np.concatenate([fftout_limbs[a].swapaxes(1, 2)[:, 16 * p:16 * p + 16].view(np.uint8) for (a, _) in terms], axis=2)
+                B = np.concatenate([key_limbs[b][:, 16 * p:16 * p + 16].view(np.uint8) for (_, b) in terms], axis=0)
+                if layout == "padded":
+                    A = np.pad(A, ((0, 0), (0, 0), (0, 64 - A.shape[2])))
+                    B = np.pad(B, ((0, 64 - B.shape[0]), (0, 0)))
+                B = vnni_pack(B)
+
+                amx.tilezero(TILE_C)
+                amx.tileloadd(tile_a, A.reshape(batch, -1), 0, A.shape[2])
+                amx.tileloadd(tile_b, B.ravel(), 0, B.shape[1])
+                getattr(amx, limb_product.instruction.lower())(TILE_C, tile_a, tile_b)
+                amx.tilestored(TILE_C, C, 0, 64)
+
+                # only the diagonal of each 16x16 product is the fftsum
+                partial[:, 16 * p:16 * p + 16] += np.diagonal(C.view(np.int32).reshape(batch, 16, 16), axis1=1, axis2=2)
+        partials.append(partial)
+
+    return recombine(partials, schedule), amx.counters
+
+def bit_split_schedule() -> LimbSchedule:
+    """
+    The 4 product hi / lo split of bit_split_amx_matmul() in src/amx-matmul.h as a schedule, with a
+    signed high key limb since the PI key is signed
+    """
+    products = build_products(LIMB_SPLITS["u8x2"], LIMB_SPLITS["s8x2"])
+    return LimbSchedule("u8x2", "s8x2", "mod257", False, False, products, 4 * len(products))
+
+def test_tile_config_round_trips_amx_dpbuud_config():
+
+    config = make_tile_config({0: (16, 64), 1: (16, 64), 2: (16, 64), 3: (1, 1)})
+    parsed = TileConfig.from_bytes(config)
+    assert parsed.rows[:4] == (16, 16, 16, 1) and parsed.colsb[:4] == (64, 64, 64, 1)
+    assert parsed.to_bytes() == config
+
+    for bad in [{0: (17, 64)}, {0: (16, 65)}, {0: (0, 64)}]:
+        try:
+            TileConfig.from_bytes(make_tile_config(bad))
+            assert False
+        except TileFault:
+            pass
+
+    print("test_tile_config_round_trips_amx_dpbuud_config()... PASS!")
+
+def test_emulated_amx_dpbuud_matches_matmul():
+
+    M, K, N = 16, 16, 16
+    A = np.random.randint(0, 256, (M, 4 * K), dtype=np.uint8)
+    B = np.random.randint(0, 256, (4 * K, N), dtype=np.uint8)
+
+    C, counters = emulate_amx_dpbuud(M, K, N, A, vnni_pack(B))
+    assert np.array_equal(C, A.astype(np.uint64) @ B.astype(np.uint64))
+    assert counters.tile_loads == 2 and counters.dot_product_ops == 1 and counters.config_loads == 1
+    assert counters.bytes_loaded == 2 * 1024 and counters.macs == M * N * 4 * K
+
+    print("test_emulated_amx_dpbuud_matches_matmul()... PASS!")
+
+def test_tdpb_signedness_and_int32_wraparound():
+
+    amx = AMXTileEmulator()
+    amx.ldtilecfg(make_tile_config({0: (1, 4), 1: (1, 4), 2: (1, 4)}))
+    ones = np.full(4, 0xFF, dtype=np.uint8)
+    amx.tileloadd(1, ones, 0, 4)
+    amx.tileloadd(2, ones, 0, 4)
+
+    # unsigned: 4 * 255 * 255, signed: 4 * (-1) * (-1), mixed: 4 * (-1) * 255
+    for (op, expected) in [(amx.tdpbuud, 4 * 255 * 255), (amx.tdpbssd, 4), (amx.tdpbsud, -4 * 255), (amx.tdpbusd, -4 * 255)]:
+        amx.tilezero(0)
+        op(0, 1, 2)
+        assert amx.tile_as_int32(0)[0, 0, 0] == expected
+
+    # accumulate past INT32_MAX
+    start = np.array([2**31 - 1], dtype=np.int32).view(np.uint8)
+    amx.tileloadd(0, start, 0, 4)
+    amx.tdpbuud(0, 1, 2)
+    assert amx.tile_as_int32(0)[0, 0, 0] == np.int32(2**31 - 1 + 4 * 255 * 255 - 2**32)
+
+    print("test_tdpb_signedness_and_int32_wraparound()... PASS!")
+
+def test_tdpb_shape_mismatch_faults():
+
+    amx = AMXTileEmulator()
+    amx.ldtilecfg(make_tile_config({0: (16, 64), 1: (16, 32), 2: (16, 64)}))
+    try:
+        amx.tdpbssd(0, 1, 2)  # A has K = 8 dwords, B has 16 rows
+        assert False
+    except TileFault:
+        pass
+
+    print("test_tdpb_shape_mismatch_faults()... PASS!")
+
+def test_emulated_fftsum_layouts_match_batched_fftsum():
+
+    key = load_pi_key()
+    fftout = generate_dummy_fftout_batch(16)
+    fftout[0] = 256
+    expected = batched_fftsum(fftout, key, reduce=True)
+
+    assert verify_schedule(bit_split_schedule(), (0, 256), (-128, 128))
+
+    counters = {}
+    for layout in ("padded", "packed"):
+        for schedule in (choose_schedule(), bit_split_schedule()):
+            result, counters[layout, schedule.fftout_split] = emulate_fftsum(fftout, key, schedule, layout)
+            assert np.array_equal(result, expected)
+
+    # packing halves the dot product ops and the bytes loaded of the chosen schedule
+    padded, packed = counters["padded", "c8x2"], counters["packed", "c8x2"]
+    assert packed.dot_product_ops == 4 and padded.dot_product_ops == 8
+    assert 2 * packed.bytes_loaded == padded.bytes_loaded and packed.config_loads == 1
+
+    print("test_emulated_fftsum_layouts_match_batched_fftsum()... PASS!")
+
+
+if __name__ == '__main__':
+    test_tile_config_round_trips_amx_dpbuud_config()
+    test_emulated_amx_dpbuud_matches_matmul()
+    test_tdpb_signedness_and_int32_wraparound()
+    test_tdpb_shape_mismatch_faults()
+    test_emulated_fftsum_layouts_match_batched_fftsum()
+
+    # cost table
+    fftout = generate_dummy_fftout_batch(1)
+    print(f"\n{'schedule':<14}{'layout':<8}{'ops':>5}{'loads':>7}{'bytes':>7}{'MACs':>8}{'configs':>9}")
+    for schedule in (bit_split_schedule(), choose_schedule(), choose_schedule(reduction="exact")):
+        for layout in ("padded", "packed"):
+            c = emulate_fftsum(fftout, schedule=schedule, layout=layout)[1]
+            name = f"{schedule.fftout_split}/{schedule.reduction}"
+            print(f"{name:<14}{layout:<8}{c.dot_product_ops:>5}{c.tile_loads:>7}{c.bytes_loaded:>7}{c.macs:>8}{c.config_loads:>9}")
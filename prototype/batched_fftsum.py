@@ -0,0 +1,153 @@
+import numpy as np
+from typing import Optional
+
+from amx_fftsum_prototype import SWIFFT_M, SWIFFT_N
+from key_artifacts import key_bundle
+
+"""
+This file contains a batched version of the fftsum component that amx_fftsum_prototype.py models
+one 32x64 fftout at a time.
+
+The AMX prototype computes four 16x32 @ 32x16 matmuls and keeps only their diagonals, which means
+15/16 of the products it forms are thrown away. The diagonal of F.T @ P is exactly the column sum
+of the hadamard product of F and P, so here we compute only that:
+
+    out[b, j] = sum_i fftout[b, i, j] * PI_key[i, j]
+
+for a whole (B, 32, 64) stack of int16 fftout blocks at once. The contraction runs over the row
+index only (a single 'bij,ij->bj' einsum accumulating straight into an int32 (B, 64) buffer), so
+no (B, 32, 64) product and no (64, 64) matmul is ever formed. The output buffer can be preallocated
+and passed back in across calls, and no intermediate ever leaves the integer domain.
+
+Bounds: |fftout| <= 2^15 and |PI_key| <= 2^8 gives |product| <= 2^23 and a sum over 32 rows of at
+most 2^28, so int32 accumulation is exact.
+"""
+
+
+SWIFFT_P = 257
+
+# largest |key| entry for which the int32 accumulation above cannot overflow
+MAX_KEY_MAGNITUDE = 256
+
+
+def load_pi_key() -> np.ndarray:
+    """ The PI key as a read-only int16 32x64 array, from its key artifact bundle (see key_artifacts.py) """
+    return key_bundle()["key"]
+
+def as_int16_key(key: np.ndarray) -> np.ndarray:
+    """ Validates a 32x64 key and returns it as int16 (without copying if it already is) """
+    key = np.asarray(key)
+    if key.shape != (SWIFFT_M, SWIFFT_N):
+        raise ValueError(f"key must have shape {(SWIFFT_M, SWIFFT_N)}, got {key.shape}")
+    if not np.issubdtype(key.dtype, np.integer):
+        raise TypeError(f"key must be an integer array, got {key.dtype}")
+    if key.size and np.abs(key.astype(np.int64)).max() > MAX_KEY_MAGNITUDE:
+        raise ValueError(f"key entries must lie in [-{MAX_KEY_MAGNITUDE}, {MAX_KEY_MAGNITUDE}]")
+    return key if key.dtype == np.int16 else key.astype(np.int16)
+
+def batched_fftsum(fftout: np.ndarray, key: Optional[np.ndarray] = None, reduce: bool = False,
+                   out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Computes np.sum(fftout[b] * key, axis=0) for every block b of a (B, 32, 64) int16 stack.
+
+    Returns a (B, 64) int32 array. If reduce is set, the sums are reduced mod 257 into [0, 256]
+    as LibSWIFFT does after its fftsum. out is an optional (B, 64) int32 buffer, passing it in makes
+    the call allocation free.
+    """
+    if fftout.ndim != 3 or fftout.shape[1:] != (SWIFFT_M, SWIFFT_N):
+        raise ValueError(f"fftout must have shape (B, {SWIFFT_M}, {SWIFFT_N}), got {fftout.shape}")
+    if fftout.dtype != np.int16:
+        raise TypeError(f"fftout must be int16, got {fftout.dtype}")
+    key = load_pi_key() if key is None else as_int16_key(key)
+
+    batch = fftout.shape[0]
+    out = _check_buffer(out, batch)
+
+    # contract over the 32 rows only (the "diagonal" work), upcasting to int32 inside the loop
+    np.einsum('bij,ij->bj', fftout, key, out=out, dtype=np.int32)
+
+    if reduce:
+        np.remainder(out, SWIFFT_P, out=out)
+
+    return out
+
+def _check_buffer(buffer: Optional[np.ndarray], batch: int) -> np.ndarray:
+    # allocate or validate a (B, 64) int32 accumulator
+    if buffer is None:
+        return np.empty((batch, SWIFFT_N), dtype=np.int32)
+    if buffer.shape != (batch, SWIFFT_N) or buffer.dtype != np.int32:
+        raise ValueError(f"out must be an int32 array of shape {(batch, SWIFFT_N)}, got {buffer.dtype} {buffer.shape}")
+    return buffer
+
+def generate_dummy_fftout_batch(batch: int, low: int = 0, high: int = SWIFFT_P) -> np.ndarray:
+    return np.random.randint(low, high, (batch, SWIFFT_M, SWIFFT_N), dtype=np.int16)
+
+def test_batched_fftsum_matches_hadamard_column_sum():
+
+    key = load_pi_key()
+
+    # full int16 range to exercise the overflow bound
+    fftout = generate_dummy_fftout_batch(100, -2**15, 2**15)
+
+    # int64 reference
+    expected = np.sum(fftout.astype(np.int64) * key.astype(np.int64), axis=1)
+
+    result = batched_fftsum(fftout)
+    assert result.dtype == np.int32 and result.shape == (100, SWIFFT_N)
+    assert np.array_equal(result, expected)
+
+    print("test_batched_fftsum_matches_hadamard_column_sum()... PASS!")
+
+def test_batched_fftsum_matches_prototype_diagonals():
+
+    from amx_fftsum_prototype import amx_hadamard_with_collapsing_sum_prototype
+
+    key = load_pi_key()
+    fftout = generate_dummy_fftout_batch(8)
+
+    result = batched_fftsum(fftout)
+    for b in range(fftout.shape[0]):
+        assert np.array_equal(result[b], amx_hadamard_with_collapsing_sum_prototype(fftout[b].astype(np.int64), key.astype(np.int64)))
+
+    print("test_batched_fftsum_matches_prototype_diagonals()... PASS!")
+
+def test_batched_fftsum_mod_257_with_preallocated_out():
+
+    key = load_pi_key()
+    fftout = generate_dummy_fftout_batch(64)
+    out = np.empty((64, SWIFFT_N), dtype=np.int32)
+
+    # reuse the same output buffer over several calls
+    for _ in range(3):
+        result = batched_fftsum(fftout, key, reduce=True, out=out)
+        assert result is out
+
+    expected = np.mod(np.sum(fftout.astype(np.int64) * key, axis=1), SWIFFT_P)
+    assert np.array_equal(out, expected)
+    assert out.min() >= 0 and out.max() < SWIFFT_P
+
+    print("test_batched_fftsum_mod_257_with_preallocated_out()... PASS!")
+
+def test_batched_fftsum_rejects_wrong_dtypes():
+
+    # int64 fftout (e.g. straight from np.random.randint) must not be silently accepted
+    try:
+        batched_fftsum(np.zeros((1, SWIFFT_M, SWIFFT_N), dtype=np.int64))
+        assert False
+    except TypeError:
+        pass
+
+    try:
+        batched_fftsum(generate_dummy_fftout_batch(2), out=np.empty((2, SWIFFT_N), dtype=np.float64))
+        assert False
+    except ValueError:
+        pass
+
+    print("test_batched_fftsum_rejects_wrong_dtypes()... PASS!")
+
+
+if __name__ == '__main__':
+    test_batched_fftsum_matches_hadamard_column_sum()
+    test_batched_fftsum_matches_prototype_diagonals()
+    test_batched_fftsum_mod_257_with_preallocated_out()
+    test_batched_fftsum_rejects_wrong_dtypes()
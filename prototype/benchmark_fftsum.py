@@ -0,0 +1,235 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from typing import Callable, Dict, List
+
+from amx_fftsum_prototype import amx_hadamard_with_collapsing_sum_prototype
+from batched_fftsum import batched_fftsum, generate_dummy_fftout_batch, load_pi_key
+from int8_limbs import limb_fftsum
+
+"""
+This file contains a benchmark harness for the candidate fftsum formulations, all run on the real
+PI key and (B, 32, 64) int16 fftout stacks with values in [0, 256]:
+
+ - hadamard_column_sum:          np.sum(fftout * key, axis=1)
+ - matmul_diagonal:              diagonal of fftout.T @ key per block
+ - partitioned_padded_prototype: amx_hadamard_with_collapsing_sum_prototype() one block at a time
+ - einsum:                       np.einsum('bij,ij->bj', fftout, key)
+ - batched_fftsum:               batched_fftsum.py, into a preallocated out
+ - batched_fftsum_mod257:        the same with the mod 257 reduction
+ - limb_fftsum:                  the int8 limb schedule of int8_limbs.py evaluated in NumPy
+
+Batches are fed in calls of at most --chunk blocks (a 1e6 block fftout stack alone is 4 GB, and the
+matmul diagonal materializes 64x64 per block). Only one call's worth of fftout is generated, so a
+batch above --chunk re-times that same stack of blocks_per_call blocks and is marked "extrapolated":
+its throughput assumes every call sees cache resident input like the first.
+
+For every batch size (1 to 1e6 blocks by default) each strategy reports blocks/sec and ns/block over
+the whole batch, and per call of blocks_per_call blocks the tracemalloc peak and the bytes of
+temporaries (peak minus the output it returns). NumPy does not expose a count of allocation events,
+so temporaries are measured in bytes. A strategy is skipped at the larger batch sizes once its
+previous ns/block predicts more than --budget seconds per measurement.
+
+Results go to a JSON file. With --compare, the run is checked against a previous JSON and exits 1
+if any strategy got slower than the baseline by more than --threshold.
+"""
+
+
+DEFAULT_BATCH_SIZES = [1, 10, 100, 1000, 10000, 100000, 1000000]
+
+Strategy = Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray]
+
+
+def hadamard_column_sum(fftout: np.ndarray, key: np.ndarray, out: np.ndarray) -> np.ndarray:
+    return np.sum(fftout * key.astype(np.int32), axis=1)
+
+def matmul_diagonal(fftout: np.ndarray, key: np.ndarray, out: np.ndarray) -> np.ndarray:
+    return np.diagonal(np.matmul(fftout.transpose(0, 2, 1).astype(np.int32), key), axis1=1, axis2=2)
+
+def partitioned_padded_prototype(fftout: np.ndarray, key: np.ndarray, out: np.ndarray) -> np.ndarray:
+    # the prototype matmuls in the input dtype, an int16 key would overflow
+    key = key.astype(np.int32)
+    for b in range(fftout.shape[0]):
+        out[b] = amx_hadamard_with_collapsing_sum_prototype(fftout[b], key)
+    return out
+
+def einsum(fftout: np.ndarray, key: np.ndarray, out: np.ndarray) -> np.ndarray:
+    return np.einsum('bij,ij->bj', fftout, key.astype(np.int32))
+
+STRATEGIES: Dict[str, Strategy] = {
+    "hadamard_column_sum": hadamard_column_sum,
+    "matmul_diagonal": matmul_diagonal,
+    "partitioned_padded_prototype": partitioned_padded_prototype,
+    "einsum": einsum,
+    "batched_fftsum": lambda fftout, key, out: batched_fftsum(fftout, key, out=out),
+    "batched_fftsum_mod257": lambda fftout, key, out: batched_fftsum(fftout, key, reduce=True, out=out),
+    "limb_fftsum": lambda fftout, key, out: limb_fftsum(fftout, key),
+}
+
+# where the results go unless --output is given, next to this file whatever the working directory
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fftsum_benchmark.json")
+
+# strategies returning residues mod 257 instead of the exact sums
+REDUCED_STRATEGIES = {"batched_fftsum_mod257", "limb_fftsum"}
+
+
+def check_strategies(names: List[str], key: np.ndarray):
+    """ Every strategy must reproduce the int64 hadamard column sum before it is timed """
+    fftout = generate_dummy_fftout_batch(8)
+    expected = np.sum(fftout.astype(np.int64) * key, axis=1)
+    for name in names:
+        result = STRATEGIES[name](fftout, key, np.empty((8, 64), dtype=np.int32))
+        assert np.array_equal(result, expected % 257 if name in REDUCED_STRATEGIES else expected), name
+
+def measure(strategy: Strategy, batch: int, key: np.ndarray, chunk: int, repeat: int) -> dict:
+    """ Times strategy over batch blocks fed in calls of at most chunk blocks, memory is per call """
+    fftout = generate_dummy_fftout_batch(min(batch, chunk))
+    out = np.empty((fftout.shape[0], 64), dtype=np.int32)
+    calls = [chunk] * (batch // chunk) + ([batch % chunk] if batch % chunk else [])
+
+    # warm up, then one traced call for memory
+    strategy(fftout, key, out)
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    result = strategy(fftout, key, out)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    returned = 0 if result is out else result.nbytes
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for n in calls:
+            strategy(fftout[:n], key, out[:n])
+        timings.append(time.perf_counter() - start)
+    seconds = float(np.median(timings))
+
+    return {
+        "blocks_per_sec": batch / seconds,
+        "ns_per_block": 1e9 * seconds / batch,
+        "calls": len(calls),
+        "blocks_per_call": fftout.shape[0],
+        "extrapolated": batch > chunk,
+        "peak_bytes_per_call": int(peak),
+        "temp_bytes_per_call": int(max(peak - returned, 0)),
+    }
+
+def run_benchmarks(names: List[str], batch_sizes: List[int], chunk: int, repeat: int, budget: float) -> dict:
+    key = load_pi_key()
+    check_strategies(names, key)
+
+    results = []
+    for name in names:
+        ns_per_block = None
+        for batch in sorted(batch_sizes):
+            entry = {"strategy": name, "batch": batch}
+            if ns_per_block is not None and ns_per_block * 1e-9 * batch * repeat > budget:
+                entry["skipped"] = f"estimated over the {budget}s budget"
+            else:
+                entry.update(measure(STRATEGIES[name], batch, key, chunk, repeat))
+                ns_per_block = entry["ns_per_block"]
+            results.append(entry)
+            print(format_entry(entry), flush=True)
+
+    return {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "chunk": chunk,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+def format_entry(entry: dict) -> str:
+    if "skipped" in entry:
+        return f"{entry['strategy']:<30}{entry['batch']:>9}   skipped ({entry['skipped']})"
+    return (f"{entry['strategy']:<30}{entry['batch']:>9}{entry['blocks_per_sec']:>14.0f} blocks/s{entry['ns_per_block']:>12.1f} ns/block"
+            f"{entry['peak_bytes_per_call']:>12} B peak{entry['temp_bytes_per_call']:>12} B temp per {entry['blocks_per_call']} block call"
+            + (" (extrapolated)" if entry["extrapolated"] else ""))
+
+def find_regressions(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """ (strategy, batch) entries whose ns/block exceeds the baseline's by more than threshold, at the same blocks per call """
+    previous = {(e["strategy"], e["batch"]): e for e in baseline["results"] if "skipped" not in e}
+    regressions = []
+    for entry in results["results"]:
+        old = previous.get((entry["strategy"], entry["batch"]))
+        if old is None or "skipped" in entry or old.get("blocks_per_call") != entry.get("blocks_per_call"):
+            continue
+        slowdown = entry["ns_per_block"] / old["ns_per_block"] - 1
+        if slowdown > threshold:
+            regressions.append(f"{entry['strategy']} @ {entry['batch']}: {old['ns_per_block']:.1f} -> {entry['ns_per_block']:.1f} ns/block (+{100 * slowdown:.0f}%)")
+    return regressions
+
+def test_all_strategies_agree():
+
+    check_strategies(list(STRATEGIES), load_pi_key())
+    print("test_all_strategies_agree()... PASS!")
+
+def test_measure_reports_every_metric():
+
+    entry = measure(STRATEGIES["batched_fftsum"], 10, load_pi_key(), chunk=4, repeat=1)
+    assert entry["calls"] == 3 and entry["blocks_per_call"] == 4 and entry["extrapolated"]
+    assert entry["ns_per_block"] > 0 and math.isclose(entry["blocks_per_sec"] * entry["ns_per_block"], 1e9)
+    # batched_fftsum writes into out, so the einsum buffers are all it allocates
+    assert entry["temp_bytes_per_call"] == entry["peak_bytes_per_call"]
+    assert not measure(STRATEGIES["batched_fftsum"], 4, load_pi_key(), chunk=4, repeat=1)["extrapolated"]
+
+    print("test_measure_reports_every_metric()... PASS!")
+
+def test_find_regressions_uses_threshold():
+
+    baseline = {"results": [{"strategy": "einsum", "batch": 10, "ns_per_block": 100.0}]}
+    results = {"results": [{"strategy": "einsum", "batch": 10, "ns_per_block": 109.0},
+                           {"strategy": "einsum", "batch": 100, "ns_per_block": 500.0}]}
+    assert find_regressions(results, baseline, 0.10) == []
+    assert len(find_regressions(results, baseline, 0.05)) == 1
+
+    # per call figures of another --chunk are not comparable
+    baseline["results"][0]["blocks_per_call"], results["results"][0]["blocks_per_call"] = 10, 4
+    assert find_regressions(results, baseline, 0.05) == []
+
+    print("test_find_regressions_uses_threshold()... PASS!")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the fftsum formulations across batch sizes")
+    parser.add_argument("--strategies", nargs="+", default=list(STRATEGIES), choices=list(STRATEGIES))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=DEFAULT_BATCH_SIZES)
+    parser.add_argument("--chunk", type=int, default=4096, help="max blocks per call")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--budget", type=float, default=10.0, help="max estimated seconds per measurement")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative ns/block slowdown")
+    parser.add_argument("--test", action="store_true", help="run the self tests instead")
+    args = parser.parse_args()
+
+    if args.test:
+        test_all_strategies_agree()
+        test_measure_reports_every_metric()
+        test_find_regressions_uses_threshold()
+        sys.exit(0)
+
+    results = run_benchmarks(args.strategies, args.batch_sizes, args.chunk, args.repeat, args.budget)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = find_regressions(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
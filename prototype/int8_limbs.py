@@ -0,0 +1,299 @@
+import numpy as np
+from functools import lru_cache
+from itertools import product
+from typing import List, NamedTuple, Optional, Tuple
+
+from amx_fftsum_prototype import SWIFFT_N
+from batched_fftsum import SWIFFT_P, batched_fftsum, generate_dummy_fftout_batch, load_pi_key
+
+"""
+This file contains the int8 limb decomposition that lets the 9+ bit fftsum operands run on AMX-INT8.
+
+AMX only multiplies 8-bit operands (TDPBSSD/TDPBSUD/TDPBUSD/TDPBUUD: signed/unsigned A times
+signed/unsigned B, accumulated into int32), but fftout residues mod 257 take 257 values and the PI
+key spans [-128, 128]. Each operand is therefore split into 8-bit limbs,
+
+    v = sum_l limb_l * 256^shift_l
+
+every (fftout limb, key limb) pair becomes one limb product over the fftsum, and the int32 partial
+sums are recombined with shifts (exactly) or, since 256 = -1 mod 257, with signs (mod 257).
+
+A schedule is the choice of limb split for each operand plus two optional transforms that only
+change representatives:
+
+ - center:   (mod 257 only) map fftout residues from [0, 256] to [-128, 128]
+ - signflip: store key entries of 128 as -128 and negate the matching fftout entry,
+             (-F) * (-K) = F * K, so the key fits a single signed limb
+
+Limb products that share a key limb and a weight can be packed into one 64-deep dot product: the two
+fftout limbs are concatenated along K and the key limb partition is stored twice, [K_p ; K_p], which
+fills the half of the tile that create_padded_partitions() fills with zeros. Every product costs 4
+TDPB* ops for the 4 partitions of the 32x64 fftsum, packed or not.
+
+choose_schedule() enumerates every split / transform combination, checks each one exhaustively
+against the int64 product over the full operand ranges, and returns the exact one with the fewest
+tile ops. For the PI key mod 257 that is centered fftout split as s + e (s = clip(F, -128, 127),
+e in {0, 1}) times a single signflipped key limb, packed: 4 TDPBSSD per fftsum, against 16 for the
+4-product hi/lo split of bit_split_amx_matmul() in src/amx-matmul.h.
+"""
+
+
+# a dot product may accumulate this many limb products in one int32 (K = 64 for a packed product)
+MAX_DOT_PRODUCT_DEPTH = 64
+
+# TDPB* ops per product, one per 16 output partition of the fftsum
+OPS_PER_PRODUCT = SWIFFT_N // 16
+
+
+class LimbSplit(NamedTuple):
+    name: str
+    signed: Tuple[bool, ...]  # per limb, low limb first
+    shifts: Tuple[int, ...]   # limb weight is 256^shift
+    min_value: int
+    max_value: int
+
+LIMB_SPLITS = {
+    "u8":   LimbSplit("u8",   (False,),       (0,),   0,      255),
+    "s8":   LimbSplit("s8",   (True,),        (0,),   -128,   127),
+    "u8x2": LimbSplit("u8x2", (False, False), (0, 1), 0,      65535),
+    "s8x2": LimbSplit("s8x2", (False, True),  (0, 1), -32768, 32767),
+    # clip to int8 plus a signed correction limb of the same weight
+    "c8x2": LimbSplit("c8x2", (True, True),   (0, 0), -256,   254),
+}
+
+class LimbProduct(NamedTuple):
+    instruction: str                    # TDPBSSD, TDPBSUD, TDPBUSD or TDPBUUD
+    terms: Tuple[Tuple[int, int], ...]  # (fftout limb, key limb) pairs concatenated along K in one dot product
+    shift: int                          # weight 256^shift of the product
+
+class LimbSchedule(NamedTuple):
+    fftout_split: str
+    key_split: str
+    reduction: str  # "exact" or "mod257"
+    center: bool
+    signflip: bool
+    products: Tuple[LimbProduct, ...]
+    tile_ops: int
+
+
+def split_limbs(values: np.ndarray, split: LimbSplit) -> List[np.ndarray]:
+    """ Splits integer values into the limbs of split, as int8 / uint8 arrays (low limb first) """
+    values = np.asarray(values, dtype=np.int32)
+    if values.size and (values.min() < split.min_value or values.max() > split.max_value):
+        raise ValueError(f"values outside [{split.min_value}, {split.max_value}] cannot be split as {split.name}")
+
+    if split.name == "c8x2":
+        clipped = np.clip(values, -128, 127)
+        limbs = [clipped, values - clipped]
+    elif len(split.signed) == 2:
+        limbs = [values & 0xFF, values >> 8]
+    else:
+        limbs = [values]
+    return [limb.astype(np.int8 if signed else np.uint8) for (limb, signed) in zip(limbs, split.signed)]
+
+def _instruction(a_signed: bool, b_signed: bool) -> str:
+    return f"TDPB{'S' if a_signed else 'U'}{'S' if b_signed else 'U'}D"
+
+def build_products(fftout_split: LimbSplit, key_split: LimbSplit) -> Tuple[LimbProduct, ...]:
+    """ All limb products, pairing up those that can share one 64-deep dot product """
+
+    # products with the same key limb, weight and fftout signedness can be concatenated along K
+    groups = {}
+    for (a, b) in product(range(len(fftout_split.signed)), range(len(key_split.signed))):
+        group = (b, fftout_split.shifts[a] + key_split.shifts[b], fftout_split.signed[a])
+        groups.setdefault(group, []).append((a, b))
+
+    products = []
+    for ((b, shift, a_signed), terms) in groups.items():
+        for i in range(0, len(terms), 2):
+            products.append(LimbProduct(_instruction(a_signed, key_split.signed[b]), tuple(terms[i:i + 2]), shift))
+    return tuple(products)
+
+def transform_operands(fftout: np.ndarray, key: np.ndarray, reduction: str, center: bool, signflip: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """ Applies a schedule's representative changes to broadcastable fftout / key integer arrays """
+    fftout = np.asarray(fftout, dtype=np.int32)
+    key = np.asarray(key, dtype=np.int32)
+
+    if signflip:
+        flip = key == 128
+        key = np.where(flip, -key, key)
+        fftout = np.where(flip, -fftout, fftout)
+
+    if reduction == "mod257":
+        fftout = np.mod(fftout, SWIFFT_P)
+        if center:
+            fftout = np.where(fftout > SWIFFT_P // 2, fftout - SWIFFT_P, fftout)
+    return fftout, key
+
+def recombine(partials: List[np.ndarray], schedule: LimbSchedule) -> np.ndarray:
+    """ Recombines per product int32 partial sums into the fftsum (mod 257 into [0, 256] if the schedule reduces) """
+    out = np.zeros(partials[0].shape, dtype=np.int32 if schedule.reduction == "mod257" else np.int64)
+    for (partial, limb_product) in zip(partials, schedule.products):
+        if schedule.reduction == "mod257":
+            # 256 = -1 mod 257
+            out += -partial if limb_product.shift % 2 else partial
+        else:
+            out += partial.astype(np.int64) << (8 * limb_product.shift)
+
+    if schedule.reduction == "mod257":
+        np.remainder(out, SWIFFT_P, out=out)
+    return out
+
+def verify_schedule(schedule: LimbSchedule, fftout_range: Tuple[int, int], key_range: Tuple[int, int]) -> bool:
+    """
+    Exhaustive check of a schedule: every (fftout, key) pair in the given inclusive ranges must
+    split into valid limbs and recombine to F * K (exactly, or mod 257), and no limb product may
+    overflow an int32 accumulator over a MAX_DOT_PRODUCT_DEPTH deep dot product.
+    """
+    F, K = np.meshgrid(np.arange(fftout_range[0], fftout_range[1] + 1), np.arange(key_range[0], key_range[1] + 1), indexing='ij')
+    F_t, K_t = transform_operands(F, K, schedule.reduction, schedule.center, schedule.signflip)
+
+    try:
+        a_limbs = [limb.astype(np.int64) for limb in split_limbs(F_t, LIMB_SPLITS[schedule.fftout_split])]
+        b_limbs = [limb.astype(np.int64) for limb in split_limbs(K_t, LIMB_SPLITS[schedule.key_split])]
+    except ValueError:
+        return False
+
+    partials = []
+    for limb_product in schedule.products:
+        partial = sum(a_limbs[a] * b_limbs[b] for (a, b) in limb_product.terms)
+        if np.abs(partial).max() * MAX_DOT_PRODUCT_DEPTH >= 2**31:
+            return False
+        partials.append(partial)
+
+    expected = F.astype(np.int64) * K
+    if schedule.reduction == "mod257":
+        return np.array_equal(recombine(partials, schedule), np.mod(expected, SWIFFT_P))
+    return np.array_equal(recombine(partials, schedule), expected)
+
+def candidate_schedules(reduction: str) -> List[LimbSchedule]:
+    candidates = []
+    for center in ([False, True] if reduction == "mod257" else [False]):
+        for signflip in [False, True]:
+            for (fftout_split, key_split) in product(LIMB_SPLITS.values(), LIMB_SPLITS.values()):
+                products = build_products(fftout_split, key_split)
+                candidates.append(LimbSchedule(fftout_split.name, key_split.name, reduction, center, signflip,
+                                               products, OPS_PER_PRODUCT * len(products)))
+    return candidates
+
+@lru_cache(maxsize=None)
+def choose_schedule(fftout_range: Tuple[int, int] = (0, SWIFFT_P - 1), key_range: Optional[Tuple[int, int]] = None,
+                    reduction: str = "mod257") -> LimbSchedule:
+    """ The exhaustively verified schedule with the fewest tile ops (ties: fewer products, fewer limbs, fewer transforms) """
+    if reduction not in ("exact", "mod257"):
+        raise ValueError(f"unknown reduction {reduction}")
+    if key_range is None:
+        key = load_pi_key()
+        key_range = (int(key.min()), int(key.max()))
+
+    def cost(schedule: LimbSchedule):
+        limbs = len(LIMB_SPLITS[schedule.fftout_split].signed) + len(LIMB_SPLITS[schedule.key_split].signed)
+        return (schedule.tile_ops, len(schedule.products), limbs, schedule.center + schedule.signflip)
+
+    for schedule in sorted(candidate_schedules(reduction), key=cost):
+        if verify_schedule(schedule, fftout_range, key_range):
+            return schedule
+    raise ValueError(f"no int8 limb schedule for fftout in {fftout_range} and key in {key_range}")
+
+def prepare_key_limbs(key: np.ndarray, schedule: LimbSchedule) -> Tuple[List[np.ndarray], np.ndarray]:
+    """ 32x64 key -> (key limbs as int8 / uint8 32x64 arrays, 32x64 mask of fftout entries to negate) """
+    key = np.asarray(key, dtype=np.int32)
+    flip = (key == 128) if schedule.signflip else np.zeros(key.shape, dtype=bool)
+    _, key_t = transform_operands(0, key, schedule.reduction, schedule.center, schedule.signflip)
+    return split_limbs(key_t, LIMB_SPLITS[schedule.key_split]), flip
+
+def prepare_fftout_limbs(fftout: np.ndarray, schedule: LimbSchedule, flip: np.ndarray) -> List[np.ndarray]:
+    """ (..., 32, 64) fftout -> its limbs as int8 / uint8 arrays, negated where flip is set """
+    fftout = np.where(flip, -np.asarray(fftout, dtype=np.int32), fftout)
+    fftout_t, _ = transform_operands(fftout, 0, schedule.reduction, schedule.center, False)
+    return split_limbs(fftout_t, LIMB_SPLITS[schedule.fftout_split])
+
+def limb_fftsum(fftout: np.ndarray, key: Optional[np.ndarray] = None, schedule: Optional[LimbSchedule] = None) -> np.ndarray:
+    """
+    fftsum of a (B, 32, 64) fftout stack evaluated the way AMX would under schedule: one int32
+    accumulation per limb product (a packed product sums its concatenated terms), then recombination.
+    """
+    key = load_pi_key() if key is None else key
+    schedule = choose_schedule() if schedule is None else schedule
+
+    key_limbs, flip = prepare_key_limbs(key, schedule)
+    fftout_limbs = prepare_fftout_limbs(fftout, schedule, flip)
+
+    partials = []
+    for limb_product in schedule.products:
+        partial = np.zeros((fftout.shape[0], SWIFFT_N), dtype=np.int32)
+        for (a, b) in limb_product.terms:
+            partial += np.einsum('bij,ij->bj', fftout_limbs[a], key_limbs[b], dtype=np.int32)
+        partials.append(partial)
+    return recombine(partials, schedule)
+
+def describe_schedule(schedule: LimbSchedule) -> str:
+    lines = [f"fftout {schedule.fftout_split} x key {schedule.key_split}, {schedule.reduction}, center={schedule.center}, "
+             f"signflip={schedule.signflip}: {schedule.tile_ops} tile ops"]
+    for limb_product in schedule.products:
+        terms = " + ".join(f"F{a}*K{b}" for (a, b) in limb_product.terms)
+        lines.append(f"  {limb_product.instruction}  ({terms}) << {8 * limb_product.shift}")
+    return "\n".join(lines)
+
+def test_best_mod_257_schedule_is_one_packed_tdpbssd():
+
+    schedule = choose_schedule()
+    assert schedule.tile_ops == 4
+    assert len(schedule.products) == 1 and schedule.products[0].instruction == "TDPBSSD"
+    assert len(schedule.products[0].terms) == 2  # packed into one 64-deep dot product
+    assert schedule.center and schedule.signflip
+
+    print("test_best_mod_257_schedule_is_one_packed_tdpbssd()... PASS!")
+
+def test_verify_schedule_rejects_inexact_splits():
+
+    # the key contains 128, which does not fit a signed limb without the sign flip
+    key_range = (-128, 128)
+    s8 = LIMB_SPLITS["s8"]
+    c8x2 = LIMB_SPLITS["c8x2"]
+    schedule = LimbSchedule("c8x2", "s8", "mod257", True, False, build_products(c8x2, s8), 4)
+    assert not verify_schedule(schedule, (0, 256), key_range)
+    assert verify_schedule(schedule._replace(signflip=True), (0, 256), key_range)
+
+    # uncentered residues up to 256 do not fit c8x2
+    assert not verify_schedule(schedule._replace(center=False, signflip=True), (0, 256), key_range)
+
+    print("test_verify_schedule_rejects_inexact_splits()... PASS!")
+
+def test_every_chosen_schedule_is_exhaustively_exact():
+
+    # PI key, the uint16 dummy key of src/amx-fftsum.c, and full 8-bit keys, exactly and mod 257
+    for key_range in [(-128, 128), (0, 63), (0, 255), (-128, 127)]:
+        for reduction in ("exact", "mod257"):
+            schedule = choose_schedule((0, 256), key_range, reduction)
+            assert verify_schedule(schedule, (0, 256), key_range)
+            if reduction == "exact":
+                # fftout alone needs two limbs of different weight here, so nothing packs
+                assert schedule.tile_ops == 8
+
+    print("test_every_chosen_schedule_is_exhaustively_exact()... PASS!")
+
+def test_limb_fftsum_matches_batched_fftsum():
+
+    key = load_pi_key()
+    fftout = generate_dummy_fftout_batch(50)
+    fftout[0] = 256  # the value that needs the correction limb
+
+    expected = np.sum(fftout.astype(np.int64) * key, axis=1)
+    assert np.array_equal(limb_fftsum(fftout, key), batched_fftsum(fftout, key, reduce=True))
+    assert np.array_equal(limb_fftsum(fftout, key, choose_schedule(reduction="exact")), expected)
+
+    # limbs are stored in 8 bits
+    key_limbs, _ = prepare_key_limbs(key, choose_schedule())
+    assert all(limb.dtype in (np.int8, np.uint8) for limb in key_limbs)
+
+    print("test_limb_fftsum_matches_batched_fftsum()... PASS!")
+
+
+if __name__ == '__main__':
+    test_best_mod_257_schedule_is_one_packed_tdpbssd()
+    test_verify_schedule_rejects_inexact_splits()
+    test_every_chosen_schedule_is_exhaustively_exact()
+    test_limb_fftsum_matches_batched_fftsum()
+    print(describe_schedule(choose_schedule()))
+    print(describe_schedule(choose_schedule(reduction="exact")))
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import os
+import numpy as np
+from typing import Dict, Optional
+
+from amx_fftsum_prototype import ORIGINAL_C_PI_KEY, SWIFFT_M, SWIFFT_N, extract_matrix_from_text
+
+"""
+This file contains the runtime side of the key artifact bundles written by
+lookup_generation/build_key_artifacts.py.
+
+A bundle is a directory holding one .npy per derived layout of a 32x64 int16 key and a manifest.json:
+
+ - key:               (32, 64) the key itself
+ - key_transposed:    (64, 32)
+ - partitions:        (4, 32, 16) the 16 column partitions of the AMX fftsum
+ - padded_partitions: (4, 64, 16) the same zero padded to a 64 row B tile, as in create_padded_partitions()
+
+The manifest records KEY_ARTIFACT_VERSION, the sha256 of the key's little-endian int16 bytes and the
+file, shape, dtype and sha256 of every array. load_key_bundle() reads only the manifest and the 4 KB
+key (to check its hash). Every other array is np.load(mmap_mode='r')-ed the first time it is indexed
+and checked against its manifest hash then, so a corrupted layout raises instead of being used.
+Bundles are cached per process by key hash, so any number of keys can be loaded side by side, and
+loading the same key twice returns the same arrays.
+
+key_bundle() is what the runtime modules use: the PI key comes from the bundle in
+DEFAULT_KEY_ARTIFACT_DIR (or $SWIFFT_KEY_ARTIFACTS) if one has been built, and is otherwise
+parsed from ORIGINAL_C_PI_KEY once per process. A bundle there whose key hash is not PI_KEY_SHA256
+(stale, or built from another key) is rejected. A custom key is derived in memory and cached by hash.
+"""
+
+
+KEY_ARTIFACT_VERSION = 1
+
+# where build_key_artifacts.py writes the PI key bundle by default
+DEFAULT_KEY_ARTIFACT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "key_artifacts", "PI_key"))
+
+# key_sha256() of ORIGINAL_C_PI_KEY, checked by test_default_bundle_is_the_pi_key()
+PI_KEY_SHA256 = "2a8ed1ff6b2b6d0d0dedea08b1747d64d4b9e01192908ce4f4f8d9a9168f23f0"
+
+KEY_ARTIFACT_SHAPES = {
+    "key": (SWIFFT_M, SWIFFT_N),
+    "key_transposed": (SWIFFT_N, SWIFFT_M),
+    "partitions": (4, SWIFFT_M, 16),
+    "padded_partitions": (4, 2 * SWIFFT_M, 16),
+}
+
+
+def key_sha256(key: np.ndarray) -> str:
+    """ sha256 of a 32x64 key as little-endian int16 bytes """
+    return hashlib.sha256(np.ascontiguousarray(key, dtype='<i2').tobytes()).hexdigest()
+
+def _array_sha256(array: np.ndarray) -> str:
+    # the per file hash of the manifest
+    return hashlib.sha256(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+def derive_key_artifacts(key: np.ndarray) -> Dict[str, np.ndarray]:
+    """ Every layout of KEY_ARTIFACT_SHAPES for a 32x64 key, as contiguous int16 arrays """
+    key = np.array(key, dtype=np.int16)
+    if key.shape != (SWIFFT_M, SWIFFT_N):
+        raise ValueError(f"key must have shape {(SWIFFT_M, SWIFFT_N)}, got {key.shape}")
+
+    partitions = np.stack(np.split(key, 4, axis=1))
+    padded_partitions = np.pad(partitions, ((0, 0), (0, SWIFFT_M), (0, 0)), 'constant')
+    return {
+        "key": key,
+        "key_transposed": np.ascontiguousarray(key.T),
+        "partitions": partitions,
+        "padded_partitions": padded_partitions,
+    }
+
+
+class KeyBundle:
+    """ The derived layouts of one key, read lazily from a bundle directory or held in memory """
+
+    def __init__(self, manifest: dict, directory: Optional[str] = None, arrays: Optional[Dict[str, np.ndarray]] = None):
+        self.manifest = manifest
+        self.directory = directory
+        self._arrays = {} if arrays is None else arrays
+
+    @property
+    def sha256(self) -> str:
+        return self.manifest["sha256"]
+
+    @property
+    def name(self) -> str:
+        return self.manifest["name"]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self._arrays:
+            entry = self.manifest["files"][name]
+            array = np.load(os.path.join(self.directory, entry["file"]), mmap_mode='r')
+            if array.shape != tuple(entry["shape"]) or array.dtype != np.dtype(entry["dtype"]):
+                raise ValueError(f"{entry['file']} in {self.directory} does not match its manifest entry")
+            # at most 8 KB, hashed once when first mapped so a stale or corrupted layout is never used
+            if _array_sha256(array) != entry["sha256"]:
+                raise ValueError(f"{entry['file']} in {self.directory} does not match its manifest hash")
+            self._arrays[name] = array
+        return self._arrays[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.manifest["files"]
+
+
+# every bundle loaded or derived in this process, by key hash
+_bundles: Dict[str, KeyBundle] = {}
+_default_bundle: Optional[KeyBundle] = None
+
+def _manifest(key: np.ndarray, name: str, arrays: Dict[str, np.ndarray]) -> dict:
+    return {
+        "version": KEY_ARTIFACT_VERSION,
+        "name": name,
+        "sha256": key_sha256(key),
+        "files": {
+            artifact: {
+                "file": f"{artifact}.npy",
+                "shape": list(array.shape),
+                "dtype": array.dtype.str,
+                "sha256": _array_sha256(array),
+            } for (artifact, array) in arrays.items()
+        },
+    }
+
+def write_key_bundle(key: np.ndarray, directory: str, name: str = "PI_key") -> dict:
+    """ Writes the bundle of key to directory and returns its manifest (written last, after every array) """
+    arrays = derive_key_artifacts(key)
+    manifest = _manifest(arrays["key"], name, arrays)
+
+    os.makedirs(directory, exist_ok=True)
+    for (artifact, array) in arrays.items():
+        np.save(os.path.join(directory, manifest["files"][artifact]["file"]), array)
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def _read_manifest(directory: str) -> dict:
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != KEY_ARTIFACT_VERSION:
+        raise ValueError(f"{directory} holds version {manifest.get('version')} key artifacts, expected {KEY_ARTIFACT_VERSION}")
+    return manifest
+
+def load_key_bundle(directory: str) -> KeyBundle:
+    """ The bundle in directory, checked against its manifest's version and key hash, cached by hash """
+    manifest = _read_manifest(directory)
+
+    # the key on disk is checked even if a bundle of the same hash is cached already
+    bundle = KeyBundle(manifest, directory)
+    if key_sha256(bundle["key"]) != manifest["sha256"]:
+        raise ValueError(f"key in {directory} does not match its manifest hash")
+    return _bundles.setdefault(bundle.sha256, bundle)
+
+def verify_key_bundle(directory: str) -> bool:
+    """ Full check of every .npy file in directory against the hashes in its manifest, bypassing the cache """
+    manifest = _read_manifest(directory)
+    for entry in manifest["files"].values():
+        array = np.load(os.path.join(directory, entry["file"]))
+        if array.shape != tuple(entry["shape"]) or array.dtype != np.dtype(entry["dtype"]):
+            return False
+        if _array_sha256(array) != entry["sha256"]:
+            return False
+    return key_sha256(np.load(os.path.join(directory, manifest["files"]["key"]["file"]))) == manifest["sha256"]
+
+def key_bundle(key: Optional[np.ndarray] = None) -> KeyBundle:
+    """ The bundle of key, the PI key by default, see the module docstring """
+    global _default_bundle
+    if key is None:
+        if _default_bundle is None:
+            directory = os.environ.get("SWIFFT_KEY_ARTIFACTS", DEFAULT_KEY_ARTIFACT_DIR)
+            if os.path.isfile(os.path.join(directory, "manifest.json")):
+                bundle = load_key_bundle(directory)
+                if bundle.sha256 != PI_KEY_SHA256:
+                    raise ValueError(f"the key artifacts in {directory} are not the PI key (sha256 {bundle.sha256}), rebuild them")
+                _default_bundle = bundle
+            else:
+                # no bundle built, parse the C source once
+                _default_bundle = _derived_bundle(extract_matrix_from_text(ORIGINAL_C_PI_KEY, SWIFFT_M, SWIFFT_N), "PI_key")
+        return _default_bundle
+    return _derived_bundle(key, "custom")
+
+def _derived_bundle(key: np.ndarray, name: str) -> KeyBundle:
+    # in memory bundle of key, unless one is cached already
+    sha256 = key_sha256(key)
+    if sha256 not in _bundles:
+        arrays = derive_key_artifacts(key)
+        for array in arrays.values():
+            array.setflags(write=False)
+        _bundles[sha256] = KeyBundle(_manifest(arrays["key"], name, arrays), arrays=arrays)
+    return _bundles[sha256]
+
+def test_derived_partitions_match_prototype_split():
+
+    key = extract_matrix_from_text(ORIGINAL_C_PI_KEY, SWIFFT_M, SWIFFT_N)
+    arrays = derive_key_artifacts(key)
+
+    assert all(arrays[name].shape == shape and arrays[name].dtype == np.int16 for (name, shape) in KEY_ARTIFACT_SHAPES.items())
+    for (p, partition) in enumerate(np.split(key, 4, axis=1)):
+        assert np.array_equal(arrays["partitions"][p], partition)
+        assert np.array_equal(arrays["padded_partitions"][p][:SWIFFT_M], partition)
+        assert not arrays["padded_partitions"][p][SWIFFT_M:].any()
+    assert np.array_equal(arrays["key_transposed"], key.T)
+
+    print("test_derived_partitions_match_prototype_split()... PASS!")
+
+def test_bundle_round_trips_lazily_and_is_cached_by_hash():
+
+    import tempfile
+
+    keys = [np.random.randint(-128, 129, (SWIFFT_M, SWIFFT_N)) for _ in range(2)]
+    with tempfile.TemporaryDirectory() as tmp:
+        directories = [os.path.join(tmp, f"key{i}") for i in range(2)]
+        for (key, directory) in zip(keys, directories):
+            write_key_bundle(key, directory, "test")
+
+        # several keys side by side, each loaded once
+        bundles = [load_key_bundle(directory) for directory in directories]
+        assert bundles[0] is not bundles[1] and load_key_bundle(directories[0]) is bundles[0]
+        assert key_bundle(keys[1]) is bundles[1]
+
+        # only the key is read until another layout is asked for
+        assert set(bundles[0]._arrays) == {"key"}
+        assert isinstance(bundles[0]["padded_partitions"], np.memmap)
+        for (key, bundle) in zip(keys, bundles):
+            for (name, array) in derive_key_artifacts(key).items():
+                assert np.array_equal(bundle[name], array)
+        assert all(verify_key_bundle(directory) for directory in directories)
+
+        # a corrupted file fails verification even though its key's bundle is cached
+        np.save(os.path.join(directories[0], "padded_partitions.npy"), np.ones(KEY_ARTIFACT_SHAPES["padded_partitions"], dtype=np.int16))
+        assert not verify_key_bundle(directories[0])
+        np.save(os.path.join(directories[0], "key.npy"), keys[1].astype(np.int16))
+        try:
+            load_key_bundle(directories[0])
+            assert False
+        except ValueError:
+            pass
+
+        # a layout corrupted after its bundle was loaded is rejected when it is first mapped
+        corrupted_key = np.random.randint(-128, 129, (SWIFFT_M, SWIFFT_N))
+        corrupted_directory = os.path.join(tmp, "corrupted")
+        write_key_bundle(corrupted_key, corrupted_directory, "test")
+        corrupted = load_key_bundle(corrupted_directory)
+        np.save(os.path.join(corrupted_directory, "padded_partitions.npy"), np.ones(KEY_ARTIFACT_SHAPES["padded_partitions"], dtype=np.int16))
+        try:
+            corrupted["padded_partitions"]
+            assert False
+        except ValueError:
+            pass
+        assert "padded_partitions" not in corrupted._arrays
+        assert np.array_equal(corrupted["partitions"], derive_key_artifacts(corrupted_key)["partitions"])
+        bundles.append(corrupted)
+
+        # a bundle of another key is never the PI key
+        global _default_bundle
+        previous, previous_env = _default_bundle, os.environ.get("SWIFFT_KEY_ARTIFACTS")
+        os.environ["SWIFFT_KEY_ARTIFACTS"], _default_bundle = directories[1], None
+        try:
+            key_bundle()
+            assert False
+        except ValueError:
+            pass
+        finally:
+            _default_bundle = previous
+            if previous_env is None:
+                del os.environ["SWIFFT_KEY_ARTIFACTS"]
+            else:
+                os.environ["SWIFFT_KEY_ARTIFACTS"] = previous_env
+
+        # drop the cached bundles before their files go away
+        for bundle in bundles:
+            del _bundles[bundle.sha256]
+
+    print("test_bundle_round_trips_lazily_and_is_cached_by_hash()... PASS!")
+
+def test_default_bundle_is_the_pi_key():
+
+    key = extract_matrix_from_text(ORIGINAL_C_PI_KEY, SWIFFT_M, SWIFFT_N)
+    assert key_sha256(key) == PI_KEY_SHA256
+    assert np.array_equal(key_bundle()["key"], key)
+    # the same key is the same bundle, whether it was built or parsed
+    assert key_bundle() is key_bundle(key)
+
+    print("test_default_bundle_is_the_pi_key()... PASS!")
+
+
+if __name__ == '__main__':
+    test_derived_partitions_match_prototype_split()
+    test_bundle_round_trips_lazily_and_is_cached_by_hash()
+    test_default_bundle_is_the_pi_key()
@@ -0,0 +1,398 @@
+import math
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from multiprocessing import shared_memory
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from amx_fftsum_prototype import SWIFFT_M, SWIFFT_N
+from batched_fftsum import SWIFFT_P, as_int16_key, batched_fftsum, generate_dummy_fftout_batch
+from key_artifacts import key_bundle
+from swifft_compression import SWIFFT_INPUT_BLOCK_SIZE, compress, generate_dummy_blocks
+from swifft_fused_lookup import build_fused_tables, fused_compress, load_fused_tables
+
+"""
+This file contains a multi-core driver around the batched fftsum (batched_fftsum.py) and the full
+SWIFFT compression (swifft_compression.py, or the fused lookup version of swifft_fused_lookup.py).
+
+A ParallelHasher owns a ProcessPoolExecutor and puts the read-only per key data in
+multiprocessing.shared_memory once, when it is created:
+
+ - the 32x64 int16 key, from its artifact bundle (key_artifacts.py)
+ - its four 64x16 zero padded partitions (the AMX B tiles of create_padded_partitions()), from the same bundle
+ - the 8 MB fused tables, if the hasher compresses with fused=True
+
+Each worker attaches to them in its initializer, so no task ever pickles a key or a table.
+
+Inputs and outputs should live in shared buffers from input_buffer() / output_buffer(). The caller
+fills the input in place, and workers write straight into the caller's output. These segments stay
+alive (and mapped in every worker after its first task on them) until the hasher is closed, so a call
+copies and allocates nothing. Row slices of a buffer work too. Only a plain ndarray input or output is
+copied through a temporary shared segment. Tasks are (segment, first row, block count) triples.
+
+Chunking is chosen in two levels from the core count and the L2 size (read from
+/sys/devices/system/cpu/cpu0/cache/index2/size, or DEFAULT_L2_BYTES):
+
+ - cache_blocks: blocks whose working set fits in L2, the inner step of every kernel
+ - task_blocks:  a multiple of cache_blocks giving every worker about TASKS_PER_WORKER tasks, so
+                 the pool stays balanced without paying a dispatch per cache sized chunk
+
+Batches of at most cache_blocks, or a hasher with one worker, run in process with no pool at all.
+"""
+
+
+# used when sysfs does not report the L2 size (e.g. outside Linux)
+DEFAULT_L2_BYTES = 1024 * 1024
+
+# tasks handed to each worker per call, more balances better, fewer dispatches less
+TASKS_PER_WORKER = 4
+
+# approximate working set per block of each kernel, inputs and intermediates included
+KERNEL_BYTES_PER_BLOCK = {
+    "fftsum":        SWIFFT_M * SWIFFT_N * 2 + SWIFFT_N * 4,      # int16 fftout + int32 out
+    "padded_fftsum": SWIFFT_M * SWIFFT_N * 2 + SWIFFT_N * 4,
+    "compress":      4 * SWIFFT_M * SWIFFT_N * 4,                 # the int32 NTT ping-pong and fold buffers
+    "fused":         SWIFFT_INPUT_BLOCK_SIZE + SWIFFT_N * (4 + 2),  # block + int32 out + int16 gathered row
+}
+
+
+class SharedArraySpec(NamedTuple):
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+class SharedRows(NamedTuple):
+    spec: SharedArraySpec
+    start: int        # first row of the segment the call works on
+    persistent: bool  # a hasher buffer that workers keep attached, or a per call temporary
+
+
+@lru_cache(maxsize=None)
+def l2_cache_bytes() -> int:
+    """ L2 size of cpu0 from sysfs ("2048K", "1M", ...), DEFAULT_L2_BYTES if it cannot be read """
+    try:
+        with open("/sys/devices/system/cpu/cpu0/cache/index2/size") as f:
+            size = f.read().strip().upper()
+    except OSError:
+        return DEFAULT_L2_BYTES
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    try:
+        return int(size[:-1]) * units[size[-1]] if size[-1] in units else int(size)
+    except (ValueError, IndexError):
+        return DEFAULT_L2_BYTES
+
+def available_cores() -> int:
+    """ Cores this process may run on (its affinity mask where supported) """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def plan_chunks(batch: int, workers: int, bytes_per_block: int, l2_bytes: Optional[int] = None) -> Tuple[int, int]:
+    """ (task_blocks, cache_blocks) for a batch spread over workers, see the module docstring """
+    l2_bytes = l2_cache_bytes() if l2_bytes is None else l2_bytes
+    cache_blocks = max(1, l2_bytes // bytes_per_block)
+    balanced = math.ceil(batch / (workers * TASKS_PER_WORKER))
+    task_blocks = max(cache_blocks, cache_blocks * math.ceil(balanced / cache_blocks))
+    return task_blocks, cache_blocks
+
+def padded_partition_fftsum(fftout: np.ndarray, partitions: np.ndarray, reduce: bool = False,
+                            out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    The fftsum from the padded partitions, one 16 column output slice per partition as the AMX kernel
+    produces it. The 32 zero rows of each partition only ever meet the zero padding of A, so they are skipped.
+    """
+    out = np.empty((fftout.shape[0], SWIFFT_N), dtype=np.int32) if out is None else out
+    for (p, partition) in enumerate(partitions):
+        np.einsum('bij,ij->bj', fftout[:, :, 16 * p:16 * p + 16], partition[:SWIFFT_M], out=out[:, 16 * p:16 * p + 16], dtype=np.int32)
+    if reduce:
+        np.remainder(out, SWIFFT_P, out=out)
+    return out
+
+def _create_shared(array: np.ndarray) -> Tuple[shared_memory.SharedMemory, SharedArraySpec]:
+    # copy array into a new shared segment
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, SharedArraySpec(shm.name, array.shape, array.dtype.str)
+
+def _create_shared_empty(shape: Tuple[int, ...], dtype) -> Tuple[shared_memory.SharedMemory, SharedArraySpec]:
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return shm, SharedArraySpec(shm.name, tuple(shape), dtype.str)
+
+def _attach(spec: SharedArraySpec) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    shm = shared_memory.SharedMemory(name=spec.name)
+    return shm, np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=shm.buf)
+
+def _release(segments: List[shared_memory.SharedMemory], unlink: bool = False):
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            # the caller still holds arrays on this segment, the mapping goes away with them
+            pass
+        if unlink:
+            shm.unlink()
+
+
+# per worker process: the shared key data attached by _init_worker() and the hasher buffers attached so far
+_worker_segments: List[shared_memory.SharedMemory] = []
+_worker_arrays: Dict[str, np.ndarray] = {}
+_worker_buffers: Dict[str, Tuple[shared_memory.SharedMemory, np.ndarray]] = {}
+
+def _init_worker(specs: Dict[str, SharedArraySpec]):
+    for (name, spec) in specs.items():
+        shm, array = _attach(spec)
+        array.setflags(write=False)
+        _worker_segments.append(shm)
+        _worker_arrays[name] = array
+
+def _run_kernel(kernel: str, arrays: Dict[str, np.ndarray], data: np.ndarray, out: np.ndarray, reduce: bool, cache_blocks: int):
+    # evaluate kernel on data into out, cache_blocks at a time
+    for start in range(0, data.shape[0], cache_blocks):
+        stop = min(start + cache_blocks, data.shape[0])
+        if kernel == "fftsum":
+            batched_fftsum(data[start:stop], arrays["key"], reduce, out=out[start:stop])
+        elif kernel == "padded_fftsum":
+            padded_partition_fftsum(data[start:stop], arrays["partitions"], reduce, out=out[start:stop])
+        elif kernel == "compress":
+            compress(data[start:stop], arrays["key"], out=out[start:stop], chunk_blocks=cache_blocks)
+        else:
+            fused_compress(data[start:stop], arrays["tables"], out=out[start:stop], chunk_blocks=cache_blocks)
+
+def _worker_rows(rows: SharedRows) -> Tuple[Optional[shared_memory.SharedMemory], np.ndarray]:
+    # hasher buffers are attached once per worker, temporaries for this task only
+    if not rows.persistent:
+        return _attach(rows.spec)
+    if rows.spec.name not in _worker_buffers:
+        _worker_buffers[rows.spec.name] = _attach(rows.spec)
+    return None, _worker_buffers[rows.spec.name][1]
+
+def _run_task(kernel: str, data_rows: SharedRows, out_rows: SharedRows, start: int, stop: int,
+              reduce: bool, cache_blocks: int):
+    data_shm, data = _worker_rows(data_rows)
+    out_shm, out = _worker_rows(out_rows)
+    try:
+        _run_kernel(kernel, _worker_arrays, data[data_rows.start + start:data_rows.start + stop],
+                    out[out_rows.start + start:out_rows.start + stop], reduce, cache_blocks)
+    finally:
+        # the views must go before their segments can be closed
+        del data, out
+        _release([shm for shm in (data_shm, out_shm) if shm is not None])
+
+
+class ParallelHasher:
+    """
+    Multi-core fftsum / SWIFFT compression for one key, see the module docstring.
+
+    Use as a context manager (or call close()) so the pool is shut down and the shared segments unlinked.
+    """
+
+    def __init__(self, key: Optional[np.ndarray] = None, workers: Optional[int] = None, fused: bool = False):
+        bundle = key_bundle(None if key is None else as_int16_key(key))
+        self.workers = available_cores() if workers is None else workers
+        if self.workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        self.fused = fused
+
+        self._arrays = {"key": bundle["key"], "partitions": bundle["padded_partitions"]}
+        if fused:
+            self._arrays["tables"] = load_fused_tables() if key is None else build_fused_tables(bundle["key"])
+
+        self._segments = []
+        self._buffers: List[Tuple[shared_memory.SharedMemory, SharedArraySpec, np.ndarray]] = []
+        self._executor = None
+        if self.workers > 1:
+            specs = {}
+            for (name, array) in self._arrays.items():
+                shm, specs[name] = _create_shared(np.ascontiguousarray(array))
+                self._segments.append(shm)
+            self._executor = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(specs,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        _release(self._segments + [shm for (shm, _, _) in self._buffers], unlink=True)
+        self._segments = []
+        self._buffers = []
+
+    def input_buffer(self, batch: int, kind: str = "fftout") -> np.ndarray:
+        """
+        Shared (B, 32, 64) int16 buffer for fftsum() (kind "fftout") or (B, 256) uint8 buffer for
+        compress() (kind "blocks"), to be filled in place and passed back in (or any row slice of it)
+        """
+        if kind == "fftout":
+            return self._shared_buffer((batch, SWIFFT_M, SWIFFT_N), np.int16)
+        if kind == "blocks":
+            return self._shared_buffer((batch, SWIFFT_INPUT_BLOCK_SIZE), np.uint8)
+        raise ValueError(f"unknown input buffer kind {kind}")
+
+    def output_buffer(self, batch: int) -> np.ndarray:
+        """ Shared (B, 64) int32 buffer the workers write results into, pass it (or a row slice) as out """
+        return self._shared_buffer((batch, SWIFFT_N), np.int32)
+
+    def _shared_buffer(self, shape: Tuple[int, ...], dtype) -> np.ndarray:
+        shm, spec = _create_shared_empty(shape, dtype)
+        array = np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=shm.buf)
+        self._buffers.append((shm, spec, array))
+        return array
+
+    def _find_shared(self, array: np.ndarray) -> Optional[SharedRows]:
+        # the rows of a hasher buffer that array is a contiguous row slice of, if any
+        if not array.flags.c_contiguous or array.shape[0] == 0:
+            return None
+        address = array.__array_interface__["data"][0]
+        for (_, spec, buffer) in self._buffers:
+            if array.dtype != buffer.dtype or array.shape[1:] != buffer.shape[1:]:
+                continue
+            offset = address - buffer.__array_interface__["data"][0]
+            row_bytes = buffer.strides[0]
+            if offset >= 0 and offset % row_bytes == 0 and offset // row_bytes + array.shape[0] <= buffer.shape[0]:
+                return SharedRows(spec, offset // row_bytes, True)
+        return None
+
+    def fftsum(self, fftout: np.ndarray, reduce: bool = False, out: Optional[np.ndarray] = None,
+               kernel: str = "fftsum") -> np.ndarray:
+        """
+        batched_fftsum() of a (B, 32, 64) int16 stack spread over the workers, kernel "padded_fftsum"
+        evaluates it from the shared padded partitions instead of the key.
+        """
+        if fftout.ndim != 3 or fftout.shape[1:] != (SWIFFT_M, SWIFFT_N):
+            raise ValueError(f"fftout must have shape (B, {SWIFFT_M}, {SWIFFT_N}), got {fftout.shape}")
+        if fftout.dtype != np.int16:
+            raise TypeError(f"fftout must be int16, got {fftout.dtype}")
+        if kernel not in ("fftsum", "padded_fftsum"):
+            raise ValueError(f"unknown fftsum kernel {kernel}")
+        return self._map(kernel, fftout, reduce, out)
+
+    def compress(self, blocks: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """ SWIFFT compression of a (B, 256) uint8 stack spread over the workers, (B, 64) int32 residues """
+        if blocks.ndim != 2 or blocks.shape[1] != SWIFFT_INPUT_BLOCK_SIZE:
+            raise ValueError(f"blocks must have shape (B, {SWIFFT_INPUT_BLOCK_SIZE}), got {blocks.shape}")
+        if blocks.dtype != np.uint8:
+            raise TypeError(f"blocks must be uint8, got {blocks.dtype}")
+        return self._map("fused" if self.fused else "compress", blocks, True, out)
+
+    def _map(self, kernel: str, data: np.ndarray, reduce: bool, out: Optional[np.ndarray]) -> np.ndarray:
+        batch = data.shape[0]
+        if out is None:
+            out = np.empty((batch, SWIFFT_N), dtype=np.int32)
+        elif out.shape != (batch, SWIFFT_N) or out.dtype != np.int32:
+            raise ValueError(f"out must be an int32 array of shape {(batch, SWIFFT_N)}, got {out.dtype} {out.shape}")
+
+        task_blocks, cache_blocks = plan_chunks(batch, self.workers, KERNEL_BYTES_PER_BLOCK[kernel])
+        if self._executor is None or batch <= cache_blocks:
+            _run_kernel(kernel, self._arrays, data, out, reduce, cache_blocks)
+            return out
+
+        # plain ndarrays go through temporary segments, hasher buffers are used in place
+        temporaries = []
+        data_rows = self._find_shared(data)
+        if data_rows is None:
+            data_shm, data_spec = _create_shared(np.ascontiguousarray(data))
+            temporaries.append(data_shm)
+            data_rows = SharedRows(data_spec, 0, False)
+        out_rows = self._find_shared(out)
+        if out_rows is None:
+            out_shm, out_spec = _create_shared_empty(out.shape, out.dtype)
+            temporaries.append(out_shm)
+            out_rows = SharedRows(out_spec, 0, False)
+
+        try:
+            futures = [self._executor.submit(_run_task, kernel, data_rows, out_rows, start, min(start + task_blocks, batch), reduce, cache_blocks)
+                       for start in range(0, batch, task_blocks)]
+            for future in futures:
+                future.result()
+            if not out_rows.persistent:
+                out[...] = np.ndarray(out.shape, dtype=out.dtype, buffer=out_shm.buf)
+        finally:
+            _release(temporaries, unlink=True)
+        return out
+
+def parallel_fftsum(fftout: np.ndarray, key: Optional[np.ndarray] = None, reduce: bool = False,
+                    workers: Optional[int] = None) -> np.ndarray:
+    """ One-off ParallelHasher.fftsum(), keep a ParallelHasher around to reuse its pool across calls """
+    with ParallelHasher(key, workers) as hasher:
+        return hasher.fftsum(fftout, reduce)
+
+def parallel_compress(blocks: np.ndarray, key: Optional[np.ndarray] = None, workers: Optional[int] = None,
+                      fused: bool = False) -> np.ndarray:
+    """ One-off ParallelHasher.compress(), keep a ParallelHasher around to reuse its pool across calls """
+    with ParallelHasher(key, workers, fused) as hasher:
+        return hasher.compress(blocks)
+
+def test_plan_chunks_fits_l2_and_balances_workers():
+
+    # 2 MB L2 and the fftsum working set
+    task_blocks, cache_blocks = plan_chunks(10 ** 6, 64, KERNEL_BYTES_PER_BLOCK["fftsum"], 2 * 1024 * 1024)
+    assert cache_blocks * KERNEL_BYTES_PER_BLOCK["fftsum"] <= 2 * 1024 * 1024
+    assert task_blocks % cache_blocks == 0
+    assert math.ceil(10 ** 6 / task_blocks) >= 64 * TASKS_PER_WORKER * 0.9
+
+    # small batches never go below one cache sized task
+    assert plan_chunks(10, 64, KERNEL_BYTES_PER_BLOCK["fftsum"], 2 * 1024 * 1024) == (cache_blocks, cache_blocks)
+
+    print("test_plan_chunks_fits_l2_and_balances_workers()... PASS!")
+
+def test_parallel_fftsum_matches_batched_fftsum():
+
+    fftout = generate_dummy_fftout_batch(3000)
+    key = np.random.randint(-128, 129, (SWIFFT_M, SWIFFT_N))
+
+    with ParallelHasher(key, workers=2) as hasher:
+        for reduce in (False, True):
+            expected = batched_fftsum(fftout, key, reduce)
+            assert np.array_equal(hasher.fftsum(fftout, reduce), expected)
+            assert np.array_equal(hasher.fftsum(fftout, reduce, kernel="padded_fftsum"), expected)
+
+    print("test_parallel_fftsum_matches_batched_fftsum()... PASS!")
+
+def test_shared_buffers_are_used_in_place():
+
+    with ParallelHasher(workers=2) as hasher:
+        fftout = hasher.input_buffer(3000)
+        out = hasher.output_buffer(3000)
+        for _ in range(2):
+            fftout[...] = generate_dummy_fftout_batch(3000)
+            segments = len(hasher._buffers)
+            assert hasher.fftsum(fftout, out=out) is out
+            assert np.array_equal(out, batched_fftsum(fftout))
+            assert len(hasher._buffers) == segments
+
+        # row slices of the buffers, and a shared input with a plain output
+        assert hasher._find_shared(fftout[1000:2500]) == SharedRows(hasher._find_shared(fftout).spec, 1000, True)
+        hasher.fftsum(fftout[1000:2500], reduce=True, out=out[:1500])
+        assert np.array_equal(out[:1500], batched_fftsum(fftout[1000:2500], reduce=True))
+        assert np.array_equal(hasher.fftsum(fftout[500:]), batched_fftsum(fftout[500:]))
+
+        blocks = hasher.input_buffer(1000, kind="blocks")
+        blocks[...] = generate_dummy_blocks(1000)
+        assert np.array_equal(hasher.compress(blocks, out=out[:1000]), compress(blocks))
+
+    print("test_shared_buffers_are_used_in_place()... PASS!")
+
+def test_parallel_compress_matches_compress():
+
+    blocks = generate_dummy_blocks(1000)
+    expected = compress(blocks)
+
+    assert np.array_equal(parallel_compress(blocks, workers=2), expected)
+    assert np.array_equal(parallel_compress(blocks, workers=2, fused=True), expected)
+    # one worker runs in process
+    assert np.array_equal(parallel_compress(blocks, workers=1), expected)
+
+    print("test_parallel_compress_matches_compress()... PASS!")
+
+
+if __name__ == '__main__':
+    test_plan_chunks_fits_l2_and_balances_workers()
+    test_parallel_fftsum_matches_batched_fftsum()
+    test_shared_buffers_are_used_in_place()
+    test_parallel_compress_matches_compress()
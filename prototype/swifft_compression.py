@@ -0,0 +1,261 @@
+import numpy as np
+from typing import Optional
+
+from amx_fftsum_prototype import SWIFFT_M, SWIFFT_N
+from batched_fftsum import SWIFFT_P, batched_fftsum, load_pi_key
+
+"""
+This file contains a vectorized reference of the full SWIFFT compression function, built around the
+fftsum modelled in amx_fftsum_prototype.py / batched_fftsum.py. Every stage works on a leading batch
+axis, so one call hashes a (B, 256) stack of input blocks:
+
+1.) Bit expansion: each 256 byte block is read as 2048 bits (little-endian within each byte) and
+    reshaped to 32 rows of 64 binary coefficients x_i(a) in Z_257[a]/(a^64 + 1).
+
+2.) FFT: each row is evaluated at the 64 odd powers of PSI = 42, a primitive 128th root of unity
+    mod 257, i.e. fftout[i, j] = sum_k x_i[k] * PSI^((2j+1)k) mod 257. This is done as a negacyclic
+    NTT: premultiply by PSI^k, then a radix-2 64-point NTT with OMEGA = PSI^2.
+
+3.) fftsum: out[j] = sum_i PI_key[i, j] * fftout[i, j] mod 257 (batched_fftsum).
+
+4.) Output encoding: the 64 residues z_j are packed as the little-endian base-257 integer
+    sum_j z_j * 257^j, which always fits in 65 bytes.
+
+This is NOT LibSWIFFT-compatible, and its outputs differ from SWIFFT_Compute for the same input and key.
+The bit to coefficient map (bit k of byte t is x_i[8t + k]) and the natural j order of fftout were
+chosen here. LibSWIFFT's byte FFT reads byte t of a row as the stride 8 coefficients x_i[t + 8k], and
+ORIGINAL_C_PI_KEY is laid out for LibSWIFFT's fftout order, so here it acts as an arbitrary key on
+the same ring. The function is still SWIFFT: z = NTT(sum_i a_i * x_i) in Z_257[a]/(a^64 + 1) with
+a_i the inverse NTT of key row i, which test_compress_matches_ring_product() checks directly. So it
+is an oracle for the fftsum kernels of src/ (which consume fftout and key blocks whatever their
+order), not for LibSWIFFT digests. swifft_fused_lookup.py and swifft_stream.py inherit this layout.
+"""
+
+
+SWIFFT_PSI = 42                 # primitive 128th root of unity mod 257
+SWIFFT_OMEGA = SWIFFT_PSI ** 2  # primitive 64th root of unity mod 257 (before reduction)
+SWIFFT_INPUT_BLOCK_SIZE = SWIFFT_M * SWIFFT_N // 8  # 256 bytes
+SWIFFT_COMPACT_OUTPUT_SIZE = 65                     # ceil(log2(257^64) / 8)
+
+# blocks processed per inner step of compress(), keeps the (64, 32 * chunk) int32 NTT buffers
+# (1 MB each) close to cache instead of streaming a whole batch through memory six times
+DEFAULT_CHUNK_BLOCKS = 128
+
+
+def _powers_mod_p(base: int, exponents: np.ndarray) -> np.ndarray:
+    return np.array([pow(base, int(e), SWIFFT_P) for e in np.ravel(exponents)], dtype=np.int32).reshape(np.shape(exponents))
+
+def _bit_reverse_permutation(n: int) -> np.ndarray:
+    bits = n.bit_length() - 1
+    return np.array([int(format(i, f"0{bits}b")[::-1], 2) for i in range(n)])
+
+# PSI^k premultiplication turning the cyclic NTT into a negacyclic one
+PSI_POWERS = _powers_mod_p(SWIFFT_PSI, np.arange(SWIFFT_N))
+
+# input permutation for the in-place decimation-in-time NTT
+BIT_REVERSE_64 = _bit_reverse_permutation(SWIFFT_N)
+
+# twiddles OMEGA^(j * 64 / (2 * half)) for every butterfly stage (half = 1, 2, 4, ..., 32)
+STAGE_TWIDDLES = [_powers_mod_p(SWIFFT_OMEGA, np.arange(half) * (SWIFFT_N // (2 * half))) for half in 2 ** np.arange(6)]
+
+# dense form of the same map, NTT_MATRIX[k, j] = PSI^((2j+1)k), used as the reference
+NTT_MATRIX = _powers_mod_p(SWIFFT_PSI, np.outer(np.arange(SWIFFT_N), 2 * np.arange(SWIFFT_N) + 1))
+
+
+def expand_bits(blocks: np.ndarray) -> np.ndarray:
+    """ (B, 256) uint8 input blocks -> (B, 32, 64) uint8 binary coefficients """
+    if blocks.ndim != 2 or blocks.shape[1] != SWIFFT_INPUT_BLOCK_SIZE:
+        raise ValueError(f"blocks must have shape (B, {SWIFFT_INPUT_BLOCK_SIZE}), got {blocks.shape}")
+    if blocks.dtype != np.uint8:
+        raise TypeError(f"blocks must be uint8, got {blocks.dtype}")
+    return np.unpackbits(blocks, axis=1, bitorder='little').reshape(-1, SWIFFT_M, SWIFFT_N)
+
+def _fold_257(x: np.ndarray, out: np.ndarray) -> np.ndarray:
+    # x = hi * 256 + lo = lo - hi (mod 257), shrinks |x| to at most 256 + |x| / 256 without a division
+    # (out must not alias x, x is clobbered)
+    np.right_shift(x, 8, out=out)
+    np.bitwise_and(x, 0xFF, out=x)
+    np.subtract(x, out, out=out)
+    return out
+
+def ntt_257(coefficients: np.ndarray) -> np.ndarray:
+    """
+    Negacyclic 64-point NTT mod 257 along the last axis of an integer array of any leading shape,
+    with coefficients in [-256, 256]. Returns int16 values in [0, 256].
+
+    Values are kept as lazily reduced signed int32 between stages: only the twiddle products are
+    folded (see _fold_257), so the magnitude at most doubles per stage (< 2^16 after all six) and a
+    single % 257 at the end gives the canonical residues.
+    """
+    lead = np.shape(coefficients)[:-1]
+    n_groups = int(np.prod(lead, dtype=np.int64))
+
+    # work coefficient-major, (64, n_groups), so every butterfly runs over a long contiguous batch axis
+    # bit reversal is folded into the PSI^k premultiplication
+    y = np.empty((SWIFFT_N, n_groups), dtype=np.int32)
+    np.multiply(np.reshape(coefficients, (n_groups, SWIFFT_N)).T[BIT_REVERSE_64], PSI_POWERS[BIT_REVERSE_64, None], out=y)
+    x = _fold_257(y, out=np.empty_like(y))
+
+    # ping-pong buffers for the butterflies
+    odd = np.empty((SWIFFT_N // 2, n_groups), dtype=np.int32)
+    folded = np.empty_like(odd)
+
+    for twiddles in STAGE_TWIDDLES:
+        half = twiddles.size
+        groups = SWIFFT_N // (2 * half)
+        src = x.reshape(groups, 2, half, n_groups)
+        dst = y.reshape(groups, 2, half, n_groups)
+
+        np.multiply(src[:, 1], twiddles[:, None], out=odd.reshape(groups, half, n_groups))
+        folded_view = _fold_257(odd, out=folded).reshape(groups, half, n_groups)
+
+        np.add(src[:, 0], folded_view, out=dst[:, 0])
+        np.subtract(src[:, 0], folded_view, out=dst[:, 1])
+        x, y = y, x
+
+    x %= SWIFFT_P
+    return x.T.astype(np.int16).reshape(*lead, SWIFFT_N)
+
+def ntt_257_reference(coefficients: np.ndarray) -> np.ndarray:
+    """ Same map as ntt_257() computed as a dense matmul with NTT_MATRIX """
+    return (np.asarray(coefficients, dtype=np.int64) @ NTT_MATRIX % SWIFFT_P).astype(np.int16)
+
+def compress(blocks: np.ndarray, key: Optional[np.ndarray] = None, out: Optional[np.ndarray] = None,
+             chunk_blocks: int = DEFAULT_CHUNK_BLOCKS) -> np.ndarray:
+    """
+    SWIFFT compression of a (B, 256) uint8 stack of input blocks.
+    Returns (B, 64) int32 residues in [0, 256], written into out if given.
+    """
+    key = load_pi_key() if key is None else key
+    batch = blocks.shape[0]
+    if out is None:
+        out = np.empty((batch, SWIFFT_N), dtype=np.int32)
+
+    for start in range(0, batch, chunk_blocks):
+        stop = min(start + chunk_blocks, batch)
+        fftout = ntt_257(expand_bits(blocks[start:stop]))
+        batched_fftsum(fftout, key, reduce=True, out=out[start:stop])
+
+    return out
+
+def encode_output(z: np.ndarray) -> np.ndarray:
+    """ (B, 64) residues mod 257 -> (B, 65) uint8 little-endian encoding of sum_j z_j * 257^j """
+    batch = z.shape[0]
+    limbs = np.zeros((batch, SWIFFT_COMPACT_OUTPUT_SIZE), dtype=np.int32)
+
+    # horner from the top coefficient: acc = acc * 257 + z_j = (acc << 8) + acc + z_j
+    for j in range(SWIFFT_N - 1, -1, -1):
+        limbs[:, 1:] += limbs[:, :-1].copy()
+        limbs[:, 0] += z[:, j]
+        # one lazy carry pass keeps every limb <= 258, the top limb never carries out since acc < 256^65
+        carries = limbs >> 8
+        limbs &= 0xFF
+        limbs[:, 1:] += carries[:, :-1]
+
+    # finish propagating the remaining carries
+    while (limbs > 0xFF).any():
+        carries = limbs >> 8
+        limbs &= 0xFF
+        limbs[:, 1:] += carries[:, :-1]
+
+    return limbs.astype(np.uint8)
+
+def compress_to_bytes(blocks: np.ndarray, key: Optional[np.ndarray] = None) -> np.ndarray:
+    """ SWIFFT compression of a (B, 256) uint8 stack to (B, 65) uint8 compact outputs """
+    return encode_output(compress(blocks, key))
+
+def generate_dummy_blocks(batch: int) -> np.ndarray:
+    return np.random.randint(0, 256, (batch, SWIFFT_INPUT_BLOCK_SIZE), dtype=np.uint8)
+
+def test_psi_is_a_primitive_128th_root_of_unity():
+
+    assert pow(SWIFFT_PSI, 64, SWIFFT_P) == SWIFFT_P - 1
+    assert pow(SWIFFT_PSI, 128, SWIFFT_P) == 1
+
+    print("test_psi_is_a_primitive_128th_root_of_unity()... PASS!")
+
+def test_ntt_matches_dense_reference():
+
+    coefficients = np.random.randint(0, SWIFFT_P, (16, SWIFFT_M, SWIFFT_N))
+    assert np.array_equal(ntt_257(coefficients), ntt_257_reference(coefficients))
+
+    print("test_ntt_matches_dense_reference()... PASS!")
+
+def test_ntt_is_negacyclic():
+    """ multiplying by a in Z_257[a]/(a^64 + 1) is a pointwise multiply by PSI^(2j+1) after the NTT """
+
+    x = np.random.randint(0, SWIFFT_P, (8, SWIFFT_N))
+    x_times_a = np.concatenate([-x[:, -1:], x[:, :-1]], axis=1) % SWIFFT_P
+
+    expected = ntt_257(x).astype(np.int64) * NTT_MATRIX[1] % SWIFFT_P
+    assert np.array_equal(ntt_257(x_times_a), expected)
+
+    print("test_ntt_is_negacyclic()... PASS!")
+
+def test_compress_matches_per_block_reference():
+
+    key = load_pi_key().astype(np.int64)
+    blocks = generate_dummy_blocks(50)
+
+    # small chunks so several inner steps run
+    result = compress(blocks, chunk_blocks=16)
+    assert result.dtype == np.int32 and result.shape == (50, SWIFFT_N)
+
+    for b in range(blocks.shape[0]):
+        bits = np.unpackbits(blocks[b], bitorder='little').reshape(SWIFFT_M, SWIFFT_N)
+        fftout = bits.astype(np.int64) @ NTT_MATRIX % SWIFFT_P
+        assert np.array_equal(result[b], np.sum(fftout * key, axis=0) % SWIFFT_P)
+
+    print("test_compress_matches_per_block_reference()... PASS!")
+
+def test_compress_matches_ring_product():
+    """ z = NTT(sum_i a_i * x_i) in Z_257[a]/(a^64 + 1), built without NTT_MATRIX or the NTT """
+
+    key = load_pi_key()
+    blocks = generate_dummy_blocks(4)
+    psi_powers = [pow(SWIFFT_PSI, e, SWIFFT_P) for e in range(2 * SWIFFT_N)]
+    n_inverse = pow(SWIFFT_N, -1, SWIFFT_P)
+
+    # a_i[k] = 64^-1 * sum_j key[i, j] * PSI^(-(2j+1)k), PSI^-e = PSI^(128 - e)
+    a = np.array([[n_inverse * sum(int(key[i, j]) * psi_powers[-((2 * j + 1) * k) % (2 * SWIFFT_N)] for j in range(SWIFFT_N)) % SWIFFT_P
+                   for k in range(SWIFFT_N)] for i in range(SWIFFT_M)], dtype=np.int64)
+
+    result = compress(blocks)
+    for b in range(blocks.shape[0]):
+        # bit k of byte t of row i is coefficient 8t + k
+        x = np.array([[(int(blocks[b, i * 8 + c // 8]) >> (c % 8)) & 1 for c in range(SWIFFT_N)] for i in range(SWIFFT_M)], dtype=np.int64)
+
+        # schoolbook negacyclic product, a^64 = -1
+        s = np.zeros(SWIFFT_N, dtype=np.int64)
+        for i in range(SWIFFT_M):
+            c = np.convolve(a[i], x[i])
+            s += c[:SWIFFT_N]
+            s[:SWIFFT_N - 1] -= c[SWIFFT_N:]
+
+        z = [sum(int(s[k]) * psi_powers[(2 * j + 1) * k % (2 * SWIFFT_N)] for k in range(SWIFFT_N)) % SWIFFT_P for j in range(SWIFFT_N)]
+        assert np.array_equal(result[b], z)
+
+    print("test_compress_matches_ring_product()... PASS!")
+
+def test_encode_output_is_base_257():
+
+    z = np.random.randint(0, SWIFFT_P, (20, SWIFFT_N)).astype(np.int32)
+    z[0] = SWIFFT_P - 1  # largest possible output
+    z[1] = 0
+
+    encoded = encode_output(z)
+    assert encoded.shape == (20, SWIFFT_COMPACT_OUTPUT_SIZE) and encoded.dtype == np.uint8
+    for b in range(z.shape[0]):
+        expected = sum(int(z[b, j]) * SWIFFT_P ** j for j in range(SWIFFT_N))
+        assert int.from_bytes(encoded[b].tobytes(), 'little') == expected
+
+    print("test_encode_output_is_base_257()... PASS!")
+
+
+if __name__ == '__main__':
+    test_psi_is_a_primitive_128th_root_of_unity()
+    test_ntt_matches_dense_reference()
+    test_ntt_is_negacyclic()
+    test_compress_matches_per_block_reference()
+    test_compress_matches_ring_product()
+    test_encode_output_is_base_257()
@@ -0,0 +1,129 @@
+import numpy as np
+from functools import lru_cache
+from typing import Optional
+
+from amx_fftsum_prototype import SWIFFT_M, SWIFFT_N
+from batched_fftsum import SWIFFT_P, as_int16_key, load_pi_key
+from swifft_compression import NTT_MATRIX, SWIFFT_INPUT_BLOCK_SIZE, compress, generate_dummy_blocks
+
+"""
+This file contains a table driven version of the full SWIFFT compression (swifft_compression.py)
+that fuses the FFT and the fftsum into lookups.
+
+Both the FFT and the fftsum are linear in the input bits, and the PI key is a fixed constant, so the
+contribution of every input byte to the 64 output residues can be precomputed with the key already
+multiplied in. Input byte p (0..255) holds bits 8t..8t+7 of row i = p // 8 (t = p % 8), so
+
+    FUSED_TABLE[p, v, j] = PI_key[i, j] * sum_k bit_k(v) * PSI^((2j+1)(8t+k))  mod 257
+
+and the whole compression becomes a gather-and-add with no FFT and no multiply per block:
+
+    out[j] = sum_p FUSED_TABLE[p, block[p], j]  mod 257
+
+Unlike the 256x8 byte table of LibSWIFFT, which only covers the first FFT stages (and reads byte t
+as the stride 8 coefficients t + 8k rather than 8t + k), each entry here holds the byte's contribution
+to all 64 coefficients, since the remaining FFT stages and the key are folded in. The table is 256 * 256 * 64 int16 = 8 MB, each per-position slice is 32 KB.
+"""
+
+
+FUSED_TABLE_SHAPE = (SWIFFT_INPUT_BLOCK_SIZE, 256, SWIFFT_N)
+
+# blocks processed per gather-and-add step of fused_compress()
+DEFAULT_CHUNK_BLOCKS = 1024
+
+
+def byte_fft_tables() -> np.ndarray:
+    """ (8, 256, 64) table of the FFT of byte value v placed at byte t of a row, mod 257 (key free) """
+    byte_bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1, bitorder='little').astype(np.int64)
+    # bits of byte t are coefficients 8t..8t+7 of the row polynomial
+    ntt_rows = NTT_MATRIX.astype(np.int64).reshape(8, 8, SWIFFT_N)
+    return (np.einsum('vk,tkj->tvj', byte_bits, ntt_rows) % SWIFFT_P).astype(np.int16)
+
+def build_fused_tables(key: Optional[np.ndarray] = None) -> np.ndarray:
+    """ (256, 256, 64) int16 FUSED_TABLE for the given key (the PI key by default) """
+    key = load_pi_key() if key is None else as_int16_key(key)
+    byte_ffts = byte_fft_tables().astype(np.int32)
+    tables = byte_ffts[None, :, :, :] * key.astype(np.int32)[:, None, None, :]
+    tables %= SWIFFT_P
+    return tables.astype(np.int16).reshape(FUSED_TABLE_SHAPE)
+
+@lru_cache(maxsize=None)
+def load_fused_tables(path: Optional[str] = None) -> np.ndarray:
+    """ The PI key's fused tables, built once per process or memory mapped from a .npy written by create_fused_fft_lookups.py """
+    if path is not None:
+        tables = np.load(path, mmap_mode='r')
+        if tables.shape != FUSED_TABLE_SHAPE or tables.dtype != np.int16:
+            raise ValueError(f"{path} does not hold int16 tables of shape {FUSED_TABLE_SHAPE}")
+        return tables
+    tables = build_fused_tables()
+    tables.setflags(write=False)
+    return tables
+
+def fused_compress(blocks: np.ndarray, tables: Optional[np.ndarray] = None, out: Optional[np.ndarray] = None,
+                   chunk_blocks: int = DEFAULT_CHUNK_BLOCKS) -> np.ndarray:
+    """
+    SWIFFT compression of a (B, 256) uint8 stack of input blocks by gather-and-add over the fused tables.
+    Returns (B, 64) int32 residues in [0, 256], identical to swifft_compression.compress().
+    """
+    if blocks.ndim != 2 or blocks.shape[1] != SWIFFT_INPUT_BLOCK_SIZE:
+        raise ValueError(f"blocks must have shape (B, {SWIFFT_INPUT_BLOCK_SIZE}), got {blocks.shape}")
+    if blocks.dtype != np.uint8:
+        raise TypeError(f"blocks must be uint8, got {blocks.dtype}")
+    tables = load_fused_tables() if tables is None else tables
+
+    batch = blocks.shape[0]
+    if out is None:
+        out = np.empty((batch, SWIFFT_N), dtype=np.int32)
+    gathered = np.empty((min(chunk_blocks, batch), SWIFFT_N), dtype=np.int16)
+
+    for start in range(0, batch, chunk_blocks):
+        stop = min(start + chunk_blocks, batch)
+        acc = out[start:stop]
+        rows = gathered[:stop - start]
+
+        # at most 256 * 256 per sum, so int32 needs no reduction until the end
+        acc[...] = 0
+        for p in range(SWIFFT_INPUT_BLOCK_SIZE):
+            np.take(tables[p], blocks[start:stop, p], axis=0, out=rows)
+            np.add(acc, rows, out=acc)
+        np.remainder(acc, SWIFFT_P, out=acc)
+
+    return out
+
+def test_byte_fft_tables_match_ntt_of_single_bytes():
+
+    byte_ffts = byte_fft_tables()
+    for t in range(8):
+        for v in (0, 1, 0x80, 0xA5, 0xFF):
+            row = np.zeros(SWIFFT_N, dtype=np.int64)
+            row[8 * t:8 * t + 8] = np.unpackbits(np.uint8(v), bitorder='little')
+            assert np.array_equal(byte_ffts[t, v], row @ NTT_MATRIX % SWIFFT_P)
+
+    print("test_byte_fft_tables_match_ntt_of_single_bytes()... PASS!")
+
+def test_fused_compress_matches_compress():
+
+    blocks = generate_dummy_blocks(300)
+
+    # small chunks so the last one is partial
+    result = fused_compress(blocks, chunk_blocks=128)
+    assert result.dtype == np.int32 and result.shape == (300, SWIFFT_N)
+    assert np.array_equal(result, compress(blocks))
+
+    print("test_fused_compress_matches_compress()... PASS!")
+
+def test_fused_tables_for_custom_key():
+
+    key = np.random.randint(-128, 129, (SWIFFT_M, SWIFFT_N))
+    blocks = generate_dummy_blocks(20)
+
+    result = fused_compress(blocks, build_fused_tables(key))
+    assert np.array_equal(result, compress(blocks, key))
+
+    print("test_fused_tables_for_custom_key()... PASS!")
+
+
+if __name__ == '__main__':
+    test_byte_fft_tables_match_ntt_of_single_bytes()
+    test_fused_compress_matches_compress()
+    test_fused_tables_for_custom_key()
@@ -0,0 +1,322 @@
+import argparse
+import io
+import os
+import select
+import sys
+import time
+import numpy as np
+from typing import BinaryIO, Iterator, Optional, Union
+
+from amx_fftsum_prototype import SWIFFT_N
+from batched_fftsum import SWIFFT_P
+from swifft_compression import SWIFFT_INPUT_BLOCK_SIZE, compress, encode_output
+from swifft_fused_lookup import load_fused_tables
+
+"""
+This file contains a streaming SWIFFT hash of files and pipes of any length, built as a Merkle-Damgard
+chain of the compression function (swifft_compression.py) evaluated with the fused lookup tables of
+swifft_fused_lookup.py.
+
+Every 256 byte compression input is the 72 byte chaining value followed by 184 message bytes:
+
+ - chaining value: the 64 residues in [0, 256] of the previous compression, the low bytes (64 bytes)
+   followed by the 9th bits packed little-endian (8 bytes); the first one is all zeros
+ - message:        bytes 72..255, the input padded with 0x80, zeros and its length in bits as a
+                   little-endian uint64 (Merkle-Damgard strengthening) to a multiple of 184 bytes
+
+The digest is the last chaining value in the 65 byte compact encoding of encode_output(). It uses the
+bit and fftout layout of swifft_compression.py, so it is not a LibSWIFFT digest.
+
+The compression is linear mod 257 in its input bits and the two parts occupy disjoint bits, so
+
+    compress(cv || m) = sum_{p >= 72} FUSED_TABLE[p, m_p] + bits(cv) @ CHAINING_MATRIX  mod 257
+
+where row j * 9 + k of the 576x64 CHAINING_MATRIX is the contribution of bit k of residue j. The
+message part has no dependency between blocks and is gathered for whole batches at once; only the
+576x64 product runs once per block. The stream is a pipeline of generators:
+
+    message_batches()  ->  message_contributions()  ->  chain()
+    (B, 184) uint8         (B, 64) int32                 (64,) int32 chaining value
+
+Regular files are memory mapped; pipes and other streams are readinto() a preallocated buffer. Every
+array along the way (input buffer, gather rows, accumulators, chaining bits) is allocated once per
+stream and reused across batches, so no step allocates per block.
+"""
+
+
+SWIFFT_CHAINING_SIZE = SWIFFT_N + SWIFFT_N // 8                           # 72 bytes
+SWIFFT_MESSAGE_BLOCK_SIZE = SWIFFT_INPUT_BLOCK_SIZE - SWIFFT_CHAINING_SIZE  # 184 bytes
+
+# message blocks per pipeline step
+DEFAULT_BATCH_BLOCKS = 4096
+
+# 0x80 plus the uint64 bit length
+MIN_PADDING = 9
+
+_RESIDUE_BITS = np.arange(9, dtype=np.int32)
+
+# the 9 bits of every residue, low bit first, as float32 rows for the BLAS chaining product
+RESIDUE_BIT_TABLE = ((np.arange(SWIFFT_P)[:, None] >> _RESIDUE_BITS) & 1).astype(np.float32)
+
+
+def chaining_bytes(cv: np.ndarray) -> np.ndarray:
+    """ (..., 64) residues -> (..., 72) uint8 chaining value bytes """
+    cv = np.asarray(cv)
+    high = np.packbits((cv >> 8).astype(np.uint8), axis=-1, bitorder='little')
+    return np.concatenate([(cv & 0xFF).astype(np.uint8), high], axis=-1)
+
+def chaining_matrix(tables: np.ndarray) -> np.ndarray:
+    """ (576, 64) float32 contribution of every chaining value bit, row j * 9 + k for bit k of residue j """
+    j = np.repeat(np.arange(SWIFFT_N), 9)
+    k = np.tile(_RESIDUE_BITS, SWIFFT_N)
+    # low bits are bit k of byte j, the 9th bits bit j % 8 of byte 64 + j // 8
+    positions = np.where(k < 8, j, SWIFFT_N + j // 8)
+    bits = np.where(k < 8, k, j % 8)
+    return np.asarray(tables[positions, 1 << bits], dtype=np.float32)
+
+def padding_length(message_length: int) -> int:
+    """ Bytes of padding that bring a message of message_length bytes to a multiple of 184 """
+    return -(message_length + MIN_PADDING) % SWIFFT_MESSAGE_BLOCK_SIZE + MIN_PADDING
+
+def _pad(buffer: np.ndarray, filled: int, message_length: int) -> int:
+    # pad the filled bytes of buffer in place, returns the padded length
+    padding = padding_length(message_length)
+    buffer[filled] = 0x80
+    buffer[filled + 1:filled + padding - 8] = 0
+    buffer[filled + padding - 8:filled + padding] = np.frombuffer(((8 * message_length) % 2**64).to_bytes(8, 'little'), dtype=np.uint8)
+    return filled + padding
+
+def message_batches(source: Union[str, BinaryIO], batch_blocks: int = DEFAULT_BATCH_BLOCKS) -> Iterator[np.ndarray]:
+    """
+    Yields the padded message as (B, 184) uint8 batches of at most batch_blocks blocks. source is a path
+    (memory mapped if it is a non-empty regular file) or a binary stream with readinto(). The batches are
+    views of one reused buffer (or of the memory map) and are only valid until the next one is requested.
+    """
+    block = SWIFFT_MESSAGE_BLOCK_SIZE
+    capacity = batch_blocks * block
+
+    if isinstance(source, str):
+        if os.path.isfile(source) and os.path.getsize(source) > 0:
+            yield from _memmap_batches(source, batch_blocks)
+            return
+        with open(source, "rb") as f:
+            yield from message_batches(f, batch_blocks)
+        return
+
+    # room for a full batch plus the at most two padding blocks
+    buffer = np.empty(capacity + 2 * block, dtype=np.uint8)
+    view = memoryview(buffer)
+    filled = 0
+    message_length = 0
+    while True:
+        n = source.readinto(view[filled:capacity])
+        if n is None:
+            # non-blocking stream with no data yet, not the end of it
+            _wait_readable(source)
+            continue
+        if n == 0:
+            break
+        filled += n
+        message_length += n
+        if filled == capacity:
+            yield buffer[:capacity].reshape(batch_blocks, block)
+            filled = 0
+
+    padded = _pad(buffer, filled, message_length)
+    yield buffer[:padded].reshape(-1, block)
+
+def _wait_readable(source: BinaryIO):
+    try:
+        fd = source.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        raise BlockingIOError("non-blocking stream without a file descriptor to wait on")
+    select.select([fd], [], [])
+
+class CountingReader:
+    """ readinto() pass-through that counts the bytes read, for the throughput of a stream of unknown size """
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def readinto(self, buffer) -> Optional[int]:
+        n = self.stream.readinto(buffer)
+        if n:
+            self.bytes_read += n
+        return n
+
+    def fileno(self) -> int:
+        return self.stream.fileno()
+
+def _memmap_batches(path: str, batch_blocks: int) -> Iterator[np.ndarray]:
+    block = SWIFFT_MESSAGE_BLOCK_SIZE
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    full_blocks = data.size // block
+
+    for start in range(0, full_blocks, batch_blocks):
+        stop = min(start + batch_blocks, full_blocks)
+        yield data[start * block:stop * block].reshape(stop - start, block)
+
+    tail = np.empty(2 * block, dtype=np.uint8)
+    filled = data.size - full_blocks * block
+    tail[:filled] = data[full_blocks * block:]
+    padded = _pad(tail, filled, data.size)
+    yield tail[:padded].reshape(-1, block)
+
+def message_contributions(batches: Iterator[np.ndarray], tables: np.ndarray) -> Iterator[np.ndarray]:
+    """ Yields sum_{p >= 72} FUSED_TABLE[p, m_p] (int32, not reduced) for each batch, in one reused accumulator """
+    acc = None
+    message_tables = tables[SWIFFT_CHAINING_SIZE:]
+
+    for batch in batches:
+        if acc is None or acc.shape[0] < batch.shape[0]:
+            acc = np.empty((batch.shape[0], SWIFFT_N), dtype=np.int32)
+            gathered = np.empty((batch.shape[0], SWIFFT_N), dtype=np.int16)
+        out, rows = acc[:batch.shape[0]], gathered[:batch.shape[0]]
+
+        # at most 184 * 256 per sum, the chaining step reduces
+        out[...] = 0
+        for p in range(SWIFFT_MESSAGE_BLOCK_SIZE):
+            np.take(message_tables[p], batch[:, p], axis=0, out=rows)
+            np.add(out, rows, out=out)
+        yield out
+
+def chain(contributions: Iterator[np.ndarray], tables: np.ndarray) -> np.ndarray:
+    """ Runs the chaining value through every block of every batch, returns the final (64,) int32 residues """
+    matrix = chaining_matrix(tables)
+    cv = np.zeros(SWIFFT_N, dtype=np.int32)
+    bits = np.empty((SWIFFT_N, 9), dtype=np.float32)
+    flat_bits = bits.reshape(-1)
+    product = np.empty(SWIFFT_N, dtype=np.float32)
+
+    # NumPy has no BLAS for integers, in float32 every sum (< 576 * 256 + 184 * 256 < 2^24) is still exact
+    for batch in contributions:
+        for message in batch:
+            np.take(RESIDUE_BIT_TABLE, cv, axis=0, out=bits)
+            np.dot(flat_bits, matrix, out=product)
+            np.add(product, message, out=cv, casting='unsafe')
+            np.remainder(cv, SWIFFT_P, out=cv)
+    return cv
+
+def swifft_hash(source: Union[str, BinaryIO, bytes], tables: Optional[np.ndarray] = None,
+                batch_blocks: int = DEFAULT_BATCH_BLOCKS) -> bytes:
+    """ 65 byte streaming SWIFFT digest of a path, a binary stream or a bytes object """
+    tables = load_fused_tables() if tables is None else tables
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    cv = chain(message_contributions(message_batches(source, batch_blocks), tables), tables)
+    return encode_output(cv[None, :])[0].tobytes()
+
+def swifft_hash_reference(message: bytes) -> bytes:
+    """ The same digest by padding in Python and calling compress() on one full 256 byte block at a time """
+    padded = np.frombuffer(message + bytes(padding_length(len(message))), dtype=np.uint8).copy()
+    _pad(padded, len(message), len(message))
+    cv = np.zeros(SWIFFT_N, dtype=np.int32)
+    for m in padded.reshape(-1, SWIFFT_MESSAGE_BLOCK_SIZE):
+        cv = compress(np.concatenate([chaining_bytes(cv), m])[None, :])[0]
+    return encode_output(cv[None, :])[0].tobytes()
+
+def test_padding_fills_whole_message_blocks():
+
+    for length in [0, 1, 174, 175, 176, 183, 184, 185, 367, 368]:
+        padding = padding_length(length)
+        assert (length + padding) % SWIFFT_MESSAGE_BLOCK_SIZE == 0
+        assert MIN_PADDING <= padding < MIN_PADDING + SWIFFT_MESSAGE_BLOCK_SIZE
+
+    print("test_padding_fills_whole_message_blocks()... PASS!")
+
+def test_chaining_matrix_is_the_chaining_value_contribution():
+
+    tables = load_fused_tables()
+    cv = np.random.randint(0, SWIFFT_P, (16, SWIFFT_N))
+    blocks = np.zeros((16, SWIFFT_INPUT_BLOCK_SIZE), dtype=np.uint8)
+    blocks[:, :SWIFFT_CHAINING_SIZE] = chaining_bytes(cv)
+
+    bits = RESIDUE_BIT_TABLE[cv].reshape(16, -1)
+    assert np.array_equal(bits @ chaining_matrix(tables) % SWIFFT_P, compress(blocks))
+
+    print("test_chaining_matrix_is_the_chaining_value_contribution()... PASS!")
+
+def test_stream_matches_reference_for_paths_and_pipes():
+
+    import tempfile
+
+    for length in [0, 100, 175, 176, 184, 5 * 184 + 3, 7 * 184]:
+        message = np.random.randint(0, 256, length, dtype=np.uint8).tobytes()
+        expected = swifft_hash_reference(message)
+
+        # batch sizes that split the message unevenly
+        assert swifft_hash(message, batch_blocks=2) == expected
+        assert swifft_hash(io.BufferedReader(io.BytesIO(message), buffer_size=7), batch_blocks=3) == expected
+
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(message)
+        try:
+            assert swifft_hash(f.name, batch_blocks=2) == expected
+        finally:
+            os.unlink(f.name)
+
+    assert len(expected) == 65
+
+    # a non-blocking stream that is not ready yet must not end the message early
+    class Stalling(io.RawIOBase):
+        def __init__(self, data):
+            self.data, self.stalled = data, False
+        def readable(self):
+            return True
+        def readinto(self, buffer):
+            if not self.stalled:
+                self.stalled = True
+                return None
+            self.stalled = False
+            n = min(len(buffer), len(self.data), 100)
+            buffer[:n], self.data = self.data[:n], self.data[n:]
+            return n
+        def fileno(self):
+            return r
+    r, w = os.pipe()
+    os.write(w, b"x")
+    try:
+        message = np.random.randint(0, 256, 1000, dtype=np.uint8).tobytes()
+        reader = CountingReader(Stalling(message))
+        assert swifft_hash(reader, batch_blocks=2) == swifft_hash_reference(message)
+        assert reader.bytes_read == len(message)
+    finally:
+        os.close(r)
+        os.close(w)
+    assert swifft_hash(b"a") != swifft_hash(b"a\x00")
+
+    print("test_stream_matches_reference_for_paths_and_pipes()... PASS!")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Streaming SWIFFT hash of files or stdin ('-')")
+    parser.add_argument("inputs", nargs="*", default=["-"])
+    parser.add_argument("--batch-blocks", type=int, default=DEFAULT_BATCH_BLOCKS, help="184 byte message blocks per pipeline step")
+    parser.add_argument("--tables", help="fused table .npy written by create_fused_fft_lookups.py (memory mapped)")
+    parser.add_argument("--test", action="store_true", help="run the self tests instead")
+    args = parser.parse_args()
+
+    if args.test:
+        test_padding_fills_whole_message_blocks()
+        test_chaining_matrix_is_the_chaining_value_contribution()
+        test_stream_matches_reference_for_paths_and_pipes()
+        sys.exit(0)
+
+    tables = load_fused_tables(args.tables)
+    for name in args.inputs:
+        # throughput of the input itself, not of the chaining and padding bytes
+        if name != "-" and os.path.isfile(name):
+            source, reader = name, None
+        else:
+            reader = CountingReader(sys.stdin.buffer if name == "-" else open(name, "rb"))
+            source = reader
+        start = time.perf_counter()
+        cv = chain(message_contributions(message_batches(source, args.batch_blocks), tables), tables)
+        seconds = time.perf_counter() - start
+        digest = encode_output(cv[None, :])[0].tobytes()
+        size = os.path.getsize(name) if reader is None else reader.bytes_read
+        if reader is not None and name != "-":
+            reader.stream.close()
+        print(f"{digest.hex()}  {name}  ({size / 1e6:.1f} MB in {seconds:.2f}s, {size / 1e6 / seconds:.2f} MB/s)")